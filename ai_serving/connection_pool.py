@@ -0,0 +1,96 @@
+import contextlib
+import json
+import socket
+import threading
+
+from .worker_templates import common
+
+
+# Long-lived connections to a model worker socket. A connection is used by one
+# request at a time, so the pool grows to the number of concurrent requests and
+# idle connections are reused by the following stage calls.
+class ConnectionPool:
+
+    def __init__(self, socket_path: str, codecs: list[str] | None = None):
+        self.socket_path = socket_path
+        # Tensor codecs in our order of preference, the model's order is used if not given
+        self.codecs = codecs
+        self.codec: str | None = None
+        # Settings the model worker reported in the ready handshake
+        self.settings: dict = {}
+        self.idle: list[socket.socket] = []
+        # Connections with a request in flight
+        self.busy: set[socket.socket] = set()
+        self.lock = threading.Lock()
+
+    def connect(self, timeout: float | None = None) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.socket_path)
+            self.handshake(sock)
+        except Exception:
+            sock.close()
+            raise
+
+        return sock
+
+    def handshake(self, sock: socket.socket):
+        # The model worker greets with the codecs it supports
+        frame = common.recv_frame(sock)
+        if frame.command != common.CMD_READY or frame.status != common.RESP_OK:
+            raise RuntimeError(f'Unexpected handshake from model worker: {frame.command}')
+        ready = json.loads(frame.payload)
+        self.settings = ready
+
+        codec = common.negotiate_codec(ready['codecs'], self.codecs)
+        common.send_frame(sock, common.CMD_CONFIGURE, common.RESP_OK, json.dumps({'codec': codec}).encode())
+        frame = common.recv_frame(sock)
+        if frame.status != common.RESP_OK:
+            raise RuntimeError(frame.payload.decode())
+
+        self.codec = codec
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self.lock:
+            sock = self.idle.pop() if self.idle else None
+
+        if sock is None:
+            sock = self.connect()
+
+        with self.lock:
+            self.busy.add(sock)
+
+        try:
+            yield sock
+        except BaseException:
+            # The connection may be in the middle of a frame, don't reuse it
+            sock.close()
+            raise
+        finally:
+            with self.lock:
+                self.busy.discard(sock)
+
+        with self.lock:
+            self.idle.append(sock)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+
+        for sock in idle:
+            sock.close()
+
+    def abort(self):
+        # Requests waiting for a response fail with a connection error instead of
+        # blocking until a hung model worker answers
+        with self.lock:
+            idle, self.idle = self.idle, []
+            busy = list(self.busy)
+
+        for sock in busy:
+            with contextlib.suppress(OSError):
+                sock.shutdown(socket.SHUT_RDWR)
+        for sock in idle:
+            sock.close()
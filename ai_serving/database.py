@@ -1,14 +1,33 @@
 import os
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 SQLALCHEMY_DATABASE_URL = os.getenv('DATABASE_URL')
+# The API talks to the same database through asyncpg
+ASYNC_DATABASE_URL = os.getenv('ASYNC_DATABASE_URL') or make_url(SQLALCHEMY_DATABASE_URL).set(
+    drivername='postgresql+asyncpg',
+)
+# Connections each API process keeps open, and opens on top of those under load
+DB_POOL_SIZE = int(os.getenv('AIS_DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.getenv('AIS_DB_MAX_OVERFLOW', '20'))
+# Seconds a request waits for a connection when all are in use
+DB_POOL_TIMEOUT = float(os.getenv('AIS_DB_POOL_TIMEOUT', '30'))
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+)
+# Objects stay loaded after commit, attributes can't be lazy loaded outside of an await
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
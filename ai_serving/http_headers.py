@@ -0,0 +1,37 @@
+from fastapi import HTTPException
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses weak comparison
+    tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags
+
+
+def parse_range(range_header: str, size: int) -> tuple[int, int] | None:
+    # First and last byte of a single byte range. None when the whole object is
+    # sent instead, for other units, multiple ranges or an invalid header
+    unit, _, byte_range = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in byte_range:
+        return None
+
+    first, dash, last = byte_range.strip().partition('-')
+    if not dash or not (first or last) or not (first or '0').isdigit() or not (last or '0').isdigit():
+        return None
+
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            return None
+    else:
+        # Suffix range, the last bytes of the object
+        start = size - min(int(last), size) if int(last) else size
+        end = size - 1
+
+    if start >= size:
+        raise HTTPException(
+            status_code=416,
+            detail='Range not satisfiable',
+            headers={'Content-Range': f'bytes */{size}'},
+        )
+    return start, end
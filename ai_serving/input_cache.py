@@ -0,0 +1,157 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from collections.abc import Iterator
+
+import appdirs
+
+from . import object_storage
+
+# Input files of jobs are kept on the node, keyed by the ETag of their object, so
+# jobs over the same files don't download them again. Shared by all workers of the node.
+INPUT_CACHE_DIR = os.getenv('AIS_INPUT_CACHE_DIR') or os.path.join(appdirs.user_cache_dir('ais_'), 'inputs')
+# Least recently used inputs are removed above this size. 0 disables the cache
+INPUT_CACHE_SIZE = int(os.getenv('AIS_INPUT_CACHE_SIZE_MB', '10240')) * 1024 * 1024
+
+# Downloads of the same object wait for each other on one of these locks
+LOCK_STRIPES = 256
+# Downloads and argument directories left over by interrupted jobs are removed after this long (seconds)
+STALE_AGE = 24 * 60 * 60
+DOWNLOAD_PREFIX = '.download_'
+
+
+def objects_dir() -> str:
+    return os.path.join(INPUT_CACHE_DIR, 'objects')
+
+
+def lock_path(key: str) -> str:
+    return os.path.join(INPUT_CACHE_DIR, 'locks', f'{int(key[:8], 16) % LOCK_STRIPES}.lock')
+
+
+def args_dir() -> str:
+    return os.path.join(INPUT_CACHE_DIR, 'args')
+
+
+def make_args_dir() -> str:
+    # Arguments of a job go to a directory on the cache's file system, so cached
+    # inputs can be hard linked into it
+    if not INPUT_CACHE_SIZE:
+        return tempfile.mkdtemp(prefix='ais_')
+
+    os.makedirs(args_dir(), exist_ok=True)
+    return tempfile.mkdtemp(prefix='ais_', dir=args_dir())
+
+
+def fetch(object_path: str, local_path: str):
+    if not INPUT_CACHE_SIZE:
+        object_storage.fget_object(object_path, local_path)
+        return
+
+    key = hashlib.sha256(object_storage.stat_object(object_path).etag.encode()).hexdigest()
+    entry_path = os.path.join(objects_dir(), key)
+
+    try:
+        link(entry_path, local_path)
+        return
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(objects_dir(), exist_ok=True)
+    os.makedirs(os.path.dirname(lock_path(key)), exist_ok=True)
+    with open(lock_path(key), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # Downloaded by another worker while waiting for the lock
+        if not os.path.exists(entry_path):
+            fill(object_path, key)
+        # Entries are only removed under their lock, this can't fail
+        link(entry_path, local_path)
+
+    evict()
+
+
+def fill(object_path: str, key: str):
+    # Renamed into place once complete, entries are never partial
+    download_path = os.path.join(objects_dir(), f'{DOWNLOAD_PREFIX}{key}')
+    try:
+        object_storage.fget_object(object_path, download_path)
+        # Shared by every job linking it, models must not modify their inputs
+        os.chmod(download_path, 0o444)
+        os.rename(download_path, os.path.join(objects_dir(), key))
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(download_path)
+        raise
+
+
+def link(entry_path: str, local_path: str):
+    # Links share the modification time of the entry, which orders the entries for eviction
+    os.utime(entry_path)
+    try:
+        os.link(entry_path, local_path)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        # File systems without hard links
+        shutil.copyfile(entry_path, local_path)
+
+
+def evict():
+    with open(os.path.join(INPUT_CACHE_DIR, 'evict.lock'), 'w') as evict_lock:
+        try:
+            fcntl.flock(evict_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Another worker is evicting
+            return
+
+        now = time.time()
+        for entry, stat in scan(args_dir()):
+            if now - stat.st_mtime > STALE_AGE:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+        total = 0
+        entries = []
+        for entry, stat in scan(objects_dir()):
+            if entry.name.startswith(DOWNLOAD_PREFIX):
+                if now - stat.st_mtime > STALE_AGE:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(entry.path)
+                continue
+            total += stat.st_size
+            entries.append((stat.st_mtime, entry.name, stat))
+
+        # Least recently used first
+        for _, key, stat in sorted(entries):
+            if total <= INPUT_CACHE_SIZE:
+                break
+            if stat.st_nlink > 1:
+                # Linked into a running job, removing it frees nothing
+                continue
+            if remove(key):
+                total -= stat.st_size
+
+
+def scan(path: str) -> Iterator[tuple[os.DirEntry, os.stat_result]]:
+    for entry in os.scandir(path):
+        try:
+            yield entry, entry.stat()
+        except FileNotFoundError:
+            # Removed by a finished job or renamed by a completed download meanwhile
+            continue
+
+
+def remove(key: str) -> bool:
+    with open(lock_path(key), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Being downloaded or linked
+            return False
+
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(os.path.join(objects_dir(), key))
+        return True
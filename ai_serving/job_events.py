@@ -0,0 +1,111 @@
+import asyncio
+import json
+import os
+
+import redis
+import redis.asyncio
+
+from . import models
+
+REDIS_URL = os.getenv('REDIS_URL')
+# Last state of a job is kept in Redis this long after its last change (seconds)
+STATE_TTL = int(os.getenv('AIS_JOB_STATE_TTL', '86400'))
+
+FINAL_STATUSES = (models.JobStatus.COMPLETED.value, models.JobStatus.FAILED.value)
+
+publisher: redis.Redis | None = None
+
+
+def state_key(job_id: int) -> str:
+    return f'ais:job:{job_id}'
+
+
+def channel(job_id: int) -> str:
+    return f'ais:job:{job_id}:events'
+
+
+def job_fields(job: models.Job) -> dict:
+    return {
+        'status': job.status.value,
+        'result_path': job.result_path,
+        'failed_log': job.failed_log,
+    }
+
+
+def publish(changes: dict[int, dict]):
+    # Changed fields are merged into the last state of each job and sent to its watchers
+    global publisher
+    if publisher is None:
+        publisher = redis.Redis.from_url(REDIS_URL)
+
+    try:
+        pipeline = publisher.pipeline(transaction=False)
+        for job_id, fields in changes.items():
+            pipeline.hset(state_key(job_id), mapping={name: json.dumps(value) for name, value in fields.items()})
+            pipeline.expire(state_key(job_id), STATE_TTL)
+            pipeline.publish(channel(job_id), json.dumps(fields))
+        pipeline.execute()
+    except redis.RedisError as e:
+        # Watchers miss an update, the job itself is not affected
+        print(f'Failed to publish events of jobs {list(changes)}: {e}')
+
+
+# Fans job events out to the watchers of this process. All watchers share one
+# Redis connection, subscribed to the channels of the jobs being watched.
+class JobWatcher:
+
+    def __init__(self):
+        self.redis: redis.asyncio.Redis | None = None
+        self.pubsub: redis.asyncio.client.PubSub | None = None
+        self.queues: dict[int, set[asyncio.Queue]] = {}  # job_id -> queue of each watcher
+        self.lock = asyncio.Lock()
+        self.reader: asyncio.Task | None = None
+
+    async def subscribe(self, job_id: int) -> asyncio.Queue:
+        async with self.lock:
+            if self.redis is None:
+                self.redis = redis.asyncio.Redis.from_url(REDIS_URL)
+                self.pubsub = self.redis.pubsub()
+
+            queue = asyncio.Queue()
+            queues = self.queues.setdefault(job_id, set())
+            if not queues:
+                await self.pubsub.subscribe(channel(job_id))
+            queues.add(queue)
+
+            if self.reader is None:
+                self.reader = asyncio.create_task(self.read())
+
+        return queue
+
+    async def unsubscribe(self, job_id: int, queue: asyncio.Queue):
+        async with self.lock:
+            queues = self.queues.get(job_id, set())
+            queues.discard(queue)
+            if not queues:
+                self.queues.pop(job_id, None)
+                await self.pubsub.unsubscribe(channel(job_id))
+
+    async def state(self, job_id: int) -> dict | None:
+        # Last published state of the job, None if it wasn't published or expired
+        fields = await self.redis.hgetall(state_key(job_id))
+        return {name.decode(): json.loads(value) for name, value in fields.items()} or None
+
+    async def read(self):
+        while True:
+            try:
+                await self.dispatch()
+            except Exception as e:
+                # The reader is shared by every watcher of the process, it must keep running
+                print(f'Failed to read job events: {e!r}')
+                await asyncio.sleep(1)
+
+    async def dispatch(self):
+        message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+        if message is None:
+            return
+
+        job_id = int(message['channel'].decode().split(':')[2])
+        changes = json.loads(message['data'])
+        for queue in self.queues.get(job_id, ()):
+            queue.put_nowait(changes)
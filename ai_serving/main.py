@@ -1,13 +1,28 @@
+import asyncio
+import hashlib
+import os
+
+from celery import group
 from fastapi import Depends, FastAPI, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
+from minio.error import S3Error
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.datastructures import UploadFile as StarletteUploadFile
 
-from . import models, object_storage, schemas, tasks
-from .database import engine, SessionLocal
+from . import http_headers, job_events, models, object_storage, result_cache, schemas, tasks
+from .database import AsyncSessionLocal, engine
+
+# Comment lines sent to idle event streams, so proxies don't close them
+EVENTS_KEEPALIVE_INTERVAL = 15
+# Result objects are passed through to clients in chunks of this size (bytes)
+RESULT_CHUNK_SIZE = 1024 * 1024
+# Uploaded files are hashed in chunks of this size (bytes)
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
 models.Base.metadata.create_all(bind=engine)
 
@@ -21,68 +36,68 @@ app.add_middleware(
     allow_headers=['*'],
 )
 
+job_watcher = job_events.JobWatcher()
+
 app.mount('/static', StaticFiles(directory='mnist/build/static'), name='static')
 templates = Jinja2Templates(directory='mnist/build')
 
 
 # Dependency
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 @app.get('/')
-def index(request: Request):
+async def index(request: Request):
     # show index.html
     return templates.TemplateResponse('index.html', {'request': request})
 
 
 @app.get('/models/', response_model=list[schemas.Model])
-def list_models(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    return db.query(models.Model).offset(skip).limit(limit).all()
+async def list_models(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_db)):
+    return (await db.scalars(select(models.Model).offset(skip).limit(limit))).all()
 
 
 @app.get('/models/{model_id}', response_model=schemas.Model)
-def read_model(model_id: int, db: Session = Depends(get_db)):
-    db_model = db.query(models.Model).filter(models.Model.id == model_id).first()
+async def read_model(model_id: int, db: AsyncSession = Depends(get_db)):
+    db_model = await db.get(models.Model, model_id)
     if db_model is None:
         raise HTTPException(status_code=404, detail='Model not found')
     return db_model
 
 
 @app.post('/models/', response_model=schemas.Model)
-def create_model(name: str, file: UploadFile, db: Session = Depends(get_db)):
+async def create_model(name: str, file: UploadFile, db: AsyncSession = Depends(get_db)):
     db_model = models.Model(name=name)
     db_model.module_path = ''
     db.add(db_model)
-    db.commit()
-    db.refresh(db_model)
+    await db.commit()
+    await db.refresh(db_model)
 
     try:
-        # Upload file to object storage
+        # Upload file to object storage, in a thread as the client is blocking
         object_path = f'models/{db_model.id}/{file.filename}'
-        object_storage.put_object(
+        await run_in_threadpool(
+            object_storage.put_object,
             object_path,
             file.file,
         )
         db_model.module_path = object_path
-        db.commit()
+        await db.commit()
     except Exception:
-        db.delete(db_model)
-        db.commit()
+        await db.delete(db_model)
+        await db.commit()
         raise
 
     return db_model
 
 
 @app.post('/jobs/', response_model=schemas.Job)
-def create_job(job: schemas.JobCreate, db: Session = Depends(get_db)):
+async def create_job(job: schemas.JobCreate, db: AsyncSession = Depends(get_db)):
     db_job = models.Job(model_id=job.dict()['model_id'])
     db.add(db_job)
-    db.flush()
+    await db.flush()
 
     try:
         for argument_info in job.dict()['argument_infos']:
@@ -94,27 +109,170 @@ def create_job(job: schemas.JobCreate, db: Session = Depends(get_db)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-    db.commit()
-    tasks.preprocess.delay(db_job.id)
-    db.refresh(db_job)
+    await db.commit()
+    await start_jobs(db, [db_job.id], [job])
+    await db.refresh(db_job)
     return db_job
 
 
+@app.post('/jobs/batch', response_model=schemas.BatchCreated)
+async def create_jobs(jobs: list[schemas.JobCreate], db: AsyncSession = Depends(get_db)):
+    if not jobs:
+        raise HTTPException(status_code=400, detail='No jobs given')
+
+    # All jobs and their arguments are inserted in one transaction with a statement per table
+    db_batch = models.Batch()
+    db.add(db_batch)
+    await db.flush()
+
+    job_ids = (await db.scalars(
+        insert(models.Job).returning(models.Job.id, sort_by_parameter_order=True),
+        [{'model_id': job.model_id, 'batch_id': db_batch.id} for job in jobs],
+    )).all()
+
+    input_args = [
+        {'job_id': job_id, **argument_info.dict()}
+        for job_id, job in zip(job_ids, jobs)
+        for argument_info in job.argument_infos
+    ]
+    if input_args:
+        await db.execute(insert(models.InputArgs), input_args)
+
+    await db.commit()
+    await start_jobs(db, job_ids, jobs)
+
+    return schemas.BatchCreated(id=db_batch.id, job_ids=job_ids)
+
+
+async def start_jobs(db: AsyncSession, job_ids: list[int], jobs: list[schemas.JobCreate]):
+    # Called after the jobs were committed, so tasks and running identical jobs always find them
+    run_ids = job_ids
+
+    if result_cache.RESULT_CACHE:
+        module_paths = dict((await db.execute(
+            select(models.Model.id, models.Model.module_path)
+            .where(models.Model.id.in_({job.model_id for job in jobs}))
+        )).all())
+        claims = await asyncio.gather(*(
+            run_in_threadpool(
+                result_cache.claim,
+                job_id,
+                module_paths[job.model_id],
+                [argument_info.dict() for argument_info in job.argument_infos],
+            )
+            for job_id, job in zip(job_ids, jobs)
+        ))
+
+        # Jobs with a cached result complete right away, jobs identical to a running one wait for it
+        hits = [
+            {'id': job_id, 'status': models.JobStatus.COMPLETED, 'result_path': result_path}
+            for job_id, (outcome, result_path) in zip(job_ids, claims) if outcome == 'hit'
+        ]
+        if hits:
+            await db.execute(update(models.Job), hits)
+            await db.commit()
+        run_ids = [job_id for job_id, (outcome, _) in zip(job_ids, claims) if outcome == 'run']
+
+    if run_ids:
+        # Publishing to the broker blocks as well
+        await run_in_threadpool(group(tasks.preprocess.s(job_id) for job_id in run_ids).apply_async)
+
+
+@app.get('/result-cache', response_model=schemas.ResultCacheStats)
+async def read_result_cache_stats():
+    return await run_in_threadpool(result_cache.stats)
+
+
+@app.get('/batches/{batch_id}', response_model=schemas.Batch)
+async def read_batch(batch_id: int, db: AsyncSession = Depends(get_db)):
+    db_batch = await db.get(models.Batch, batch_id)
+    if db_batch is None:
+        raise HTTPException(status_code=404, detail='Batch not found')
+
+    statuses = dict((await db.execute(
+        select(models.Job.status, func.count())
+        .where(models.Job.batch_id == batch_id)
+        .group_by(models.Job.status)
+    )).all())
+
+    return schemas.Batch(
+        id=db_batch.id,
+        created_at=db_batch.created_at,
+        updated_at=db_batch.updated_at,
+        total=sum(statuses.values()),
+        statuses=statuses,
+    )
+
+
 @app.get('/jobs/{job_id}', response_model=schemas.Job)
-def read_job(job_id: str, db: Session = Depends(get_db)):
-    db_job = db.query(models.Job).filter(models.Job.id == job_id).first()
+async def read_job(job_id: int, db: AsyncSession = Depends(get_db)):
+    db_job = await db.get(models.Job, job_id)
     if db_job is None:
         raise HTTPException(status_code=404, detail='Job not found')
     return db_job
 
 
+@app.get('/jobs/{job_id}/events')
+async def stream_job_events(job_id: int):
+    # Server-sent events with the job's state, the first one right away and then
+    # on every change until the job completed or failed
+    queue = await job_watcher.subscribe(job_id)
+
+    try:
+        state = await job_watcher.state(job_id)
+        if state is None or 'status' not in state:
+            # Not published yet or expired, or only progress was published so far.
+            # Published fields are newer than the row.
+            db_state = await read_job_state(job_id)
+            state = {**db_state, **(state or {})} if db_state is not None else None
+    except BaseException:
+        await job_watcher.unsubscribe(job_id, queue)
+        raise
+
+    if state is None:
+        await job_watcher.unsubscribe(job_id, queue)
+        raise HTTPException(status_code=404, detail='Job not found')
+
+    async def stream():
+        try:
+            while True:
+                event = schemas.JobEvent(id=job_id, **state)
+                yield f'event: job\ndata: {event.model_dump_json()}\n\n'
+                if state['status'] in job_events.FINAL_STATUSES:
+                    break
+
+                while True:
+                    try:
+                        changes = await asyncio.wait_for(queue.get(), EVENTS_KEEPALIVE_INTERVAL)
+                        break
+                    except asyncio.TimeoutError:
+                        yield ': keepalive\n\n'
+                state.update(changes)
+        finally:
+            await job_watcher.unsubscribe(job_id, queue)
+
+    return StreamingResponse(
+        stream(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+async def read_job_state(job_id: int) -> dict | None:
+    async with AsyncSessionLocal() as db:
+        db_job = await db.get(models.Job, job_id)
+        if db_job is None:
+            return None
+        return {**job_events.job_fields(db_job), 'progress': db_job.progress}
+
+
 @app.get('/jobs/', response_model=list[schemas.Job])
-def read_jobs(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    return db.query(models.Job).offset(skip).limit(limit).all()
+async def read_jobs(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_db)):
+    return (await db.scalars(select(models.Job).offset(skip).limit(limit))).all()
 
 
 @app.post('/uploads/')
-def upload_values(value_list: list[UploadFile | str]) -> schemas.ArgsCreated:
+async def upload_values(value_list: list[UploadFile | str]) -> schemas.ArgsCreated:
     arg_infos = []
 
     for idx, value in enumerate(value_list):
@@ -126,11 +284,7 @@ def upload_values(value_list: list[UploadFile | str]) -> schemas.ArgsCreated:
                     index=idx
                 ))
             elif isinstance(value, StarletteUploadFile):  # Only file
-                object_path = f'uploads/{value.filename}'  # TODO: Need unique filename
-                object_storage.put_object(
-                    object_path,
-                    value.file,
-                )
+                object_path = await run_in_threadpool(store_upload, value)
                 arg_infos.append(schemas.ArgInfo(
                     value=object_path,
                     type=models.Type.FILE,
@@ -144,7 +298,89 @@ def upload_values(value_list: list[UploadFile | str]) -> schemas.ArgsCreated:
     return schemas.ArgsCreated(argument_infos=arg_infos)
 
 
+@app.post('/uploads/check', response_model=schemas.UploadsFound)
+async def check_uploads(digests: list[schemas.UploadDigest]):
+    # Lets clients skip sending files that were uploaded before
+    object_paths = [upload_path(digest.sha256, digest.filename) for digest in digests]
+    found = await asyncio.gather(*(
+        run_in_threadpool(object_storage.object_exists, object_path) for object_path in object_paths
+    ))
+    return schemas.UploadsFound(paths=[
+        object_path if exists else None for object_path, exists in zip(object_paths, found)
+    ])
+
+
+def upload_path(digest: str, filename: str | None) -> str:
+    # Files are stored under the digest of their content, the same file is stored once.
+    # The extension is kept as models may depend on it
+    _, extension = os.path.splitext(filename or '')
+    return f'uploads/{digest}{extension}'
+
+
+def store_upload(file: StarletteUploadFile) -> str:
+    # The file was already received into a spooled temporary file, it is read
+    # once to hash it and once more only if it's not stored yet
+    digest = hashlib.sha256()
+    while chunk := file.file.read(UPLOAD_CHUNK_SIZE):
+        digest.update(chunk)
+
+    object_path = upload_path(digest.hexdigest(), file.filename)
+    if not object_storage.object_exists(object_path):
+        file.file.seek(0)
+        object_storage.put_object(object_path, file.file)
+    return object_path
+
+
 @app.get('/results/{path:path}')
-def get_result(path: str):
-    res = object_storage.get_object(path)
-    return Response(res.data, media_type='application/octet-stream')
+async def get_result(path: str, request: Request):
+    try:
+        stat = await run_in_threadpool(object_storage.stat_object, path)
+    except S3Error as e:
+        if e.code == 'NoSuchKey':
+            raise HTTPException(status_code=404, detail='Result not found')
+        raise
+
+    etag = f'"{stat.etag}"'
+    headers = {'ETag': etag, 'Accept-Ranges': 'bytes'}
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and http_headers.etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    byte_range = None
+    # A range of an older version of the result is useless, the whole result is sent instead
+    if 'Range' in request.headers and request.headers.get('If-Range', etag) == etag:
+        byte_range = http_headers.parse_range(request.headers['Range'], stat.size)
+
+    if byte_range:
+        start, end = byte_range
+        headers['Content-Range'] = f'bytes {start}-{end}/{stat.size}'
+    else:
+        start, end = 0, stat.size - 1
+    headers['Content-Length'] = str(end - start + 1)
+
+    try:
+        # The body must be the version the headers describe
+        res = await run_in_threadpool(
+            object_storage.get_object, path, start, end - start + 1, object_storage.if_match(stat.etag),
+        )
+    except S3Error as e:
+        if e.code == 'PreconditionFailed':
+            raise HTTPException(status_code=503, detail='Result was replaced, retry', headers={'Retry-After': '1'})
+        raise
+
+    async def stream():
+        try:
+            while chunk := await run_in_threadpool(res.read, RESULT_CHUNK_SIZE):
+                yield chunk
+        finally:
+            # Also when the client disconnects, so the connection goes back to the pool
+            res.close()
+            res.release_conn()
+
+    return StreamingResponse(
+        stream(),
+        status_code=206 if byte_range else 200,
+        headers=headers,
+        media_type=stat.content_type or 'application/octet-stream',
+    )
@@ -0,0 +1,143 @@
+import collections
+import contextlib
+import os
+import threading
+import time
+
+from collections.abc import Callable, Iterator
+
+from .model_worker import ModelWorker
+
+# Total memory (PSS) of the loaded model processes, least recently used models are stopped above it. 0 = unlimited
+MEMORY_BUDGET = int(os.getenv('AIS_MODEL_MEMORY_BUDGET_MB', '0')) * 1024 * 1024
+# Models unused for this many seconds are stopped. 0 = never
+IDLE_TIMEOUT = float(os.getenv('AIS_MODEL_IDLE_TIMEOUT', '0'))
+
+
+class ModelCache:
+
+    def __init__(self, loader: Callable[[int], ModelWorker],
+                 memory_budget: int = MEMORY_BUDGET, idle_timeout: float = IDLE_TIMEOUT):
+        self.loader = loader
+        self.memory_budget = memory_budget
+        self.idle_timeout = idle_timeout
+
+        # Least recently used first
+        self.workers: collections.OrderedDict[int, ModelWorker] = collections.OrderedDict()
+        self.last_used: dict[int, float] = {}
+        # Requests currently running on each model, these models are never evicted
+        self.in_use: collections.Counter[int] = collections.Counter()
+        self.lock = threading.Lock()
+        self.load_locks: dict[int, threading.Lock] = {}
+        self.reaper: threading.Thread | None = None
+
+    @contextlib.contextmanager
+    def use(self, model_id: int) -> Iterator[ModelWorker]:
+        worker = self.acquire(model_id)
+        try:
+            yield worker
+        finally:
+            with self.lock:
+                self.in_use[model_id] -= 1
+                self.touch(model_id)
+            self.evict()
+
+    def get(self, model_id: int) -> ModelWorker:
+        # Loads the model if needed without keeping it in use
+        with self.use(model_id) as worker:
+            return worker
+
+    def loaded(self, model_id: int) -> ModelWorker | None:
+        # The model if it is loaded, without loading it or marking it used
+        with self.lock:
+            return self.workers.get(model_id)
+
+    def acquire(self, model_id: int) -> ModelWorker:
+        with self.lock:
+            if model_id in self.workers:
+                return self.mark_in_use(model_id)
+            load_lock = self.load_locks.setdefault(model_id, threading.Lock())
+
+        with load_lock:
+            with self.lock:
+                if model_id in self.workers:
+                    # Loaded by another thread meanwhile
+                    return self.mark_in_use(model_id)
+
+            # Returns once the model process reported that load() finished
+            worker = self.loader(model_id)
+
+            with self.lock:
+                self.workers[model_id] = worker
+                self.mark_in_use(model_id)
+                self.start_reaper()
+
+        # Make room for the model just loaded
+        self.evict()
+        return worker
+
+    def mark_in_use(self, model_id: int) -> ModelWorker:
+        self.in_use[model_id] += 1
+        self.touch(model_id)
+        return self.workers[model_id]
+
+    def touch(self, model_id: int):
+        if model_id in self.workers:
+            self.workers.move_to_end(model_id)
+            self.last_used[model_id] = time.monotonic()
+
+    def evict(self):
+        with self.lock:
+            now = time.monotonic()
+            # Models between the stages of a job keep the segments passed to the next stage
+            candidates = [
+                model_id for model_id, worker in self.workers.items()
+                if not self.in_use[model_id] and not worker.has_pending_segments()
+            ]
+            victims = []
+
+            if self.idle_timeout:
+                victims += [model_id for model_id in candidates
+                            if now - self.last_used[model_id] > self.idle_timeout]
+
+            if self.memory_budget:
+                usage = {model_id: worker.memory_usage() for model_id, worker in self.workers.items()}
+                total = sum(usage[model_id] for model_id in usage if model_id not in victims)
+                # The most recently used model stays loaded even if it alone exceeds the budget
+                most_recent = next(reversed(self.workers), None)
+                for model_id in candidates:
+                    if total <= self.memory_budget:
+                        break
+                    if model_id not in victims and model_id != most_recent:
+                        victims.append(model_id)
+                        total -= usage[model_id]
+
+            workers = [self.remove(model_id) for model_id in victims]
+
+        # Stopping waits for the process to exit, other models stay usable meanwhile
+        for worker in workers:
+            worker.stop()
+
+    def remove(self, model_id: int) -> ModelWorker:
+        del self.last_used[model_id]
+        del self.in_use[model_id]
+        return self.workers.pop(model_id)
+
+    def start_reaper(self):
+        if not self.idle_timeout or self.reaper:
+            return
+
+        self.reaper = threading.Thread(target=self.reap, name='model_reaper', daemon=True)
+        self.reaper.start()
+
+    def reap(self):
+        while True:
+            time.sleep(min(self.idle_timeout, 60))
+            self.evict()
+
+    def stop_all(self):
+        with self.lock:
+            workers = [self.remove(model_id) for model_id in list(self.workers)]
+
+        for worker in workers:
+            worker.stop()
@@ -1,96 +1,608 @@
+import contextlib
+import fcntl
+import hashlib
+import itertools
+import json
+import mimetypes
 import os
+import platform
+import shlex
 import shutil
-import socket
+import signal
 import stat
 import subprocess
+import sys
+import tarfile
 import tempfile
+import threading
 import time
 import venv
 
+from collections.abc import Callable
+
 import appdirs
+from minio.error import S3Error
 
-from . import models, object_storage
+from . import input_cache, models, object_storage
+from .connection_pool import ConnectionPool
 from .worker_templates import common
 
+MODEL_LOAD_TIMEOUT = float(os.getenv('AIS_MODEL_LOAD_TIMEOUT', '600'))
+# Time a model process gets to exit on SIGTERM before it is killed
+MODEL_STOP_TIMEOUT = float(os.getenv('AIS_MODEL_STOP_TIMEOUT', '10'))
+# Preferred tensor codecs, e.g. "lz4,raw". The model's preference is used when empty.
+TENSOR_CODECS = [codec for codec in os.getenv('AIS_TENSOR_CODECS', '').split(',') if codec]
+# Share installed environments between nodes through object storage
+ENV_SNAPSHOTS = os.getenv('AIS_ENV_SNAPSHOTS', 'true').lower() == 'true'
+PIP_CACHE_DIR = os.getenv('AIS_PIP_CACHE_DIR')
+# Model processes are pinged this often and restarted when they exited or didn't answer in time
+HEALTH_CHECK_INTERVAL = float(os.getenv('AIS_HEALTH_CHECK_INTERVAL', '5'))
+HEALTH_CHECK_TIMEOUT = float(os.getenv('AIS_HEALTH_CHECK_TIMEOUT', '30'))
+# A stage call taking longer than this fails, and the model process running it is
+# restarted as hung. 0 = no limit
+STAGE_TIMEOUT = float(os.getenv('AIS_STAGE_TIMEOUT', '3600'))
+# Delay before restarting a failed model process, doubled for every failure in a row
+RESTART_BACKOFF = float(os.getenv('AIS_RESTART_BACKOFF', '1'))
+RESTART_BACKOFF_MAX = float(os.getenv('AIS_RESTART_BACKOFF_MAX', '60'))
+
+# Segments handed to the next stage keep their model loaded for at most this long and are
+# unlinked after it, in case the stage never runs (seconds)
+SEGMENT_TIMEOUT = 60 * 60
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# Receives "status:progress:total" reported by the model during a stage call
+ProgressCallback = Callable[[str], None]
+
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    with open(path, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(common.CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# One model process with its own socket and run directory. Replicas forked by a
+# zygote are not our children, they are only known by pid and stopped with the zygote.
+class Replica:
+
+    def __init__(self, command: list[str] | None, run_dir: str, pid: int | None = None):
+        self.command = command
+        self.run_dir = run_dir
+        # Requests sent and not answered yet, stage calls go to the least busy replica
+        self.pending = 0
+        self.pool = ConnectionPool(self.socket_path, TENSOR_CODECS or None)
+        self.process: subprocess.Popen | None = None
+        self.forked_pid = pid
+        self.started_at = time.monotonic()
+        # Set once loaded, cleared when the supervisor takes the replica out of service
+        self.ready = False
+        self.failure: str | None = None
+
+    def start(self):
+        os.makedirs(self.run_dir, exist_ok=True)
+        # Remove leftovers of a previous run, the socket appears once the model is loaded
+        for path in (self.socket_path, self.error_path):
+            if os.path.exists(path):
+                os.unlink(path)
+
+        self.started_at = time.monotonic()
+        self.process = subprocess.Popen(
+            self.command,
+            cwd=self.run_dir,
+        )
+
+    def wait_ready(self, deadline: float):
+        while not os.path.exists(self.socket_path):
+            if not self.alive():
+                raise RuntimeError(self.read_error() or f'Model worker {self.pid} exited')
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'Model worker in {self.run_dir} was not loaded in {MODEL_LOAD_TIMEOUT} seconds')
+            time.sleep(0.05)
+
+        # Open the first connection, it completes the ready handshake
+        with self.pool.connection():
+            pass
+
+        self.ready = True
+
+    def read_error(self) -> str | None:
+        if not os.path.exists(self.error_path):
+            return None
+
+        with open(self.error_path, 'r') as f:
+            return f.read()
+
+    def request(self, command: int, payload: bytes | bytearray, request_id: int,
+                progress: ProgressCallback | None = None) -> common.Frame:
+        deadline = time.monotonic() + STAGE_TIMEOUT if STAGE_TIMEOUT else None
+        try:
+            with self.pool.connection() as sock:
+                sock.settimeout(STAGE_TIMEOUT or None)
+                common.send_frame(sock, command, common.RESP_OK, payload, request_id)
+                while True:
+                    if deadline:
+                        sock.settimeout(max(deadline - time.monotonic(), 0.001))
+                    frame = common.recv_frame(sock)
+                    if frame.command != common.CMD_PROGRESS:
+                        return frame
+                    if progress and frame.request_id == request_id:
+                        progress(frame.payload.decode())
+        except TimeoutError as e:
+            # The connection is dropped, the health check tells whether the model is stuck
+            raise TimeoutError(
+                f'Model worker {self.pid} did not answer {common.STAGE_NAMES[command]} in {STAGE_TIMEOUT} seconds'
+            ) from e
+        except OSError as e:
+            error = self.failure or self.read_error() or (None if self.alive() else f'Model worker {self.pid} exited')
+            if error:
+                raise RuntimeError(error) from e
+            raise
+
+    def check(self) -> str | None:
+        # Why the replica is unhealthy, None if it answered a ping in time
+        if not self.alive():
+            return self.read_error() or f'Model worker {self.pid} exited'
+
+        try:
+            sock = self.pool.connect(timeout=HEALTH_CHECK_TIMEOUT)
+            try:
+                common.send_frame(sock, common.CMD_PING, common.RESP_OK)
+                frame = common.recv_frame(sock)
+            finally:
+                sock.close()
+        except Exception as e:
+            return f'Model worker {self.pid} did not answer a health check: {e!r}'
+
+        # The process answers while a stage thread is stuck in model code
+        for stage, age in json.loads(frame.payload)['running'].items():
+            if STAGE_TIMEOUT and age > STAGE_TIMEOUT:
+                return f'Model worker {self.pid} has been running {stage} for {age:.0f} seconds'
+
+        return None
+
+    def fail(self, failure: str):
+        # Requests in flight fail with this error instead of waiting for the response
+        self.ready = False
+        self.failure = failure
+        self.pool.abort()
+
+    def alive(self) -> bool:
+        if self.process:
+            return self.process.poll() is None
+
+        # Exited forks stay zombies until the zygote reaps them
+        try:
+            with open(f'/proc/{self.pid}/stat') as f:
+                return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+        except FileNotFoundError:
+            return False
+
+    def memory_usage(self) -> int:
+        # Proportional set size of the model process in bytes. Pages shared with
+        # the zygote and other replicas are split between them, so the sum over
+        # replicas is the memory they actually use.
+        try:
+            with open(f'/proc/{self.pid}/smaps_rollup') as f:
+                for line in f:
+                    if line.startswith('Pss:'):
+                        return int(line.split()[1]) * 1024
+        except FileNotFoundError:
+            pass
+
+        # Resident set size on kernels without smaps_rollup
+        try:
+            with open(f'/proc/{self.pid}/statm') as f:
+                return int(f.read().split()[1]) * PAGE_SIZE
+        except FileNotFoundError:
+            return 0
+
+    def stop(self):
+        self.pool.close()
+        if self.process is None:
+            # Forks are stopped by the zygote, unless it was killed
+            if self.forked_pid and self.alive():
+                with contextlib.suppress(ProcessLookupError):
+                    os.kill(self.forked_pid, signal.SIGTERM)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.socket_path)
+            return
+
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=MODEL_STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.socket_path)
+
+    @property
+    def pid(self) -> int | None:
+        return self.process.pid if self.process else self.forked_pid
+
+    @property
+    def settings(self) -> dict:
+        return self.pool.settings
+
+    @property
+    def socket_path(self):
+        return os.path.join(
+            self.run_dir,
+            common.SOCK_NAME,
+        )
+
+    @property
+    def error_path(self):
+        return os.path.join(
+            self.run_dir,
+            'error.txt',
+        )
+
 
 class ModelWorker:
 
     def __init__(self, model: models.Model):
         self.model = model
+        self.request_ids = itertools.count(1)
+        # Shared memory segments created by the model processes and when, unlinked once consumed
+        self.segments: dict[str, float] = {}
+        self.replicas: list[Replica] = []
+        self.lock = threading.Lock()
+        # Failures in a row and earliest restart time of each replica
+        self.failures: list[int] = []
+        self.restart_at: list[float] = []
+        self.check_now = threading.Event()
+        self.stopping = threading.Event()
 
         self.setup()
 
     def setup(self):
         self.install_model_files()
-        self.start_model_worker()
+        try:
+            self.start_replicas()
+        except BaseException:
+            self.stop()
+            raise
 
-    def install_model_files(self):
-        if not os.path.exists(self.venv_dir):
-            venv.create(self.venv_dir, with_pip=True)
+        # Forks can only be restarted together with their zygote
+        self.zygote = bool(self.replicas[0].settings.get('forks'))
+        self.failures = [0] * len(self.replicas)
+        self.restart_at = [0.0] * len(self.replicas)
+        threading.Thread(target=self.supervise, name='model_supervisor', daemon=True).start()
 
-        # Extract model files to venv/model
-        # TODO: Copy from object storage
-        res = object_storage.get_object(self.model.module_path)
-        filename = os.path.basename(self.model.module_path)
-        archive_path = os.path.join(self.venv_dir, filename)
-        with open(archive_path, 'wb') as file:
-            file.write(res.read())
-        shutil.unpack_archive(archive_path, self.model_dir)
-
-        setup_path = os.path.join(self.model_dir, 'setup')
-        if os.path.exists(setup_path):
-            # Ensure setup script is executable
-            current_mode = stat.S_IMODE(os.lstat(setup_path).st_mode)
-            os.chmod(setup_path, current_mode | stat.S_IXUSR)
-            # Run setup script inside venv
-            print('Running setup script!!!!')
-            subprocess.run(
-                ['bash', '-c', '. ../bin/activate && ./setup'],
-                cwd=self.model_dir
-            )
+    def install_model_files(self):
+        # Environments are cached by content: model files under the archive's hash
+        # and virtualenvs under the hash of what gets installed in them. The index
+        # maps the archive's object to both, so a warm start only stats the object.
+        obj = object_storage.stat_object(self.model.module_path)
+        index = self.read_index()
+
+        if index.get('etag') == obj.etag and self.is_installed(index.get('archive_key'), index.get('env_key')):
+            self.app_dir = os.path.join(self.cache_dir, 'artifacts', index['archive_key'])
+            self.venv_dir = os.path.join(self.cache_dir, 'envs', index['env_key'])
         else:
-            # Install model dependencies from venv/model/requirements.txt
+            if index.get('etag') == obj.etag and self.is_extracted(index.get('archive_key')):
+                # Only the environment is missing, e.g. its install was interrupted
+                archive_key = index['archive_key']
+                self.app_dir = os.path.join(self.cache_dir, 'artifacts', archive_key)
+            else:
+                archive_key = self.extract_model_files(obj.etag)
+                self.write_index({'etag': obj.etag, 'archive_key': archive_key})
+            env_key = self.environment_key(archive_key)
+            self.install_environment(env_key)
+            self.write_index({'etag': obj.etag, 'archive_key': archive_key, 'env_key': env_key})
+
+        # Templates are cheap to copy and may change with this package
+        shutil.copytree(self.template_dir, self.app_dir, dirs_exist_ok=True)
+        aiserving_path = os.path.join(self.template_dir, 'aiserving.py')
+        shutil.copy(aiserving_path, os.path.join(self.model_dir, 'aiserving.py'))
+
+    def extract_model_files(self, etag: str) -> str:
+        os.makedirs(os.path.join(self.cache_dir, 'artifacts'), exist_ok=True)
+
+        with tempfile.TemporaryDirectory(dir=self.cache_dir) as tmp_dir:
+            # Streamed to disk, archives can be larger than the worker's memory. The
+            # ETag pins the version the index will refer to.
+            filename = os.path.basename(self.model.module_path)
+            archive_path = os.path.join(tmp_dir, filename)
+            object_storage.fget_object(self.model.module_path, archive_path, etag=etag)
+
+            archive_key = file_digest(archive_path)
+            self.app_dir = os.path.join(self.cache_dir, 'artifacts', archive_key)
+
+            if not os.path.exists(self.app_dir):
+                extract_dir = os.path.join(tmp_dir, 'app')
+                shutil.unpack_archive(archive_path, os.path.join(extract_dir, 'model'))
+                try:
+                    os.rename(extract_dir, self.app_dir)
+                except OSError:
+                    # Extracted by another worker meanwhile
+                    pass
+
+        return archive_key
+
+    def environment_key(self, archive_key: str) -> str:
+        # Environments are shared between nodes, they must run the same platform and Python
+        digest = hashlib.sha256(f'{sys.platform} {platform.machine()} {sys.version}'.encode())
+
+        for name in ('requirements.txt', 'setup'):
+            path = os.path.join(self.model_dir, name)
+            digest.update(f'\0{name}\0'.encode())
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+
+        if os.path.exists(os.path.join(self.model_dir, 'setup')):
+            # Setup scripts can do anything, their environment is not shared with other archives
+            digest.update(archive_key.encode())
+
+        return digest.hexdigest()
+
+    def install_environment(self, env_key: str):
+        envs_dir = os.path.join(self.cache_dir, 'envs')
+        os.makedirs(envs_dir, exist_ok=True)
+        self.venv_dir = os.path.join(envs_dir, env_key)
+        ready_path = os.path.join(self.venv_dir, '.ready')
+
+        with file_lock(os.path.join(envs_dir, f'{env_key}.lock')):
+            if os.path.exists(ready_path):
+                return
+
+            if os.path.exists(self.venv_dir):
+                # Left over by an interrupted install
+                shutil.rmtree(self.venv_dir)
+
+            # Another node may have installed this environment already
+            if self.restore_environment(env_key):
+                open(ready_path, 'w').close()
+                return
+
+            venv.create(self.venv_dir, with_pip=True)
+            # Wheels built or downloaded by earlier installs on this node are reused
+            pip_env = {**os.environ, 'PIP_CACHE_DIR': PIP_CACHE_DIR or os.path.join(self.cache_dir, 'pip')}
+
+            setup_path = os.path.join(self.model_dir, 'setup')
+            requirements_path = os.path.join(self.model_dir, 'requirements.txt')
+            if os.path.exists(setup_path):
+                # Ensure setup script is executable
+                current_mode = stat.S_IMODE(os.lstat(setup_path).st_mode)
+                os.chmod(setup_path, current_mode | stat.S_IXUSR)
+                # Run setup script inside venv
+                print('Running setup script!!!!')
+                activate_path = os.path.join(self.venv_dir, 'bin', 'activate')
+                subprocess.run(
+                    ['bash', '-c', f'. {shlex.quote(activate_path)} && ./setup'],
+                    cwd=self.model_dir,
+                    env=pip_env,
+                    check=True,
+                )
+            elif os.path.exists(requirements_path):
+                # Install model dependencies from model/requirements.txt
+                subprocess.run(
+                    [
+                        os.path.join(self.venv_dir, 'bin', 'pip'),
+                        'install',
+                        '-r',
+                        requirements_path,
+                    ],
+                    stdout=subprocess.DEVNULL,
+                    env=pip_env,
+                    check=True,
+                )
+
+            # Ensure install numpy
             subprocess.run(
                 [
                     os.path.join(self.venv_dir, 'bin', 'pip'),
                     'install',
-                    '-r',
-                    os.path.join(self.model_dir, 'requirements.txt'),
+                    'numpy',
                 ],
                 stdout=subprocess.DEVNULL,
+                env=pip_env,
+                check=True,
             )
-        aiserving_path = os.path.join(self.template_dir, 'aiserving.py')
-        shutil.copy(aiserving_path, os.path.join(self.model_dir, 'aiserving.py'))
 
-        # Ensure install numpy
-        subprocess.run(
-            [
-                os.path.join(self.venv_dir, 'bin', 'pip'),
-                'install',
-                'numpy',
-            ],
-            stdout=subprocess.DEVNULL,
+            open(ready_path, 'w').close()
+
+        if ENV_SNAPSHOTS:
+            threading.Thread(
+                target=self.upload_environment,
+                args=(env_key,),
+                name='upload_environment',
+                daemon=True,
+            ).start()
+
+    def restore_environment(self, env_key: str) -> bool:
+        if not ENV_SNAPSHOTS:
+            return False
+
+        object_path = f'envs/{env_key}.tar.gz'
+        try:
+            object_storage.stat_object(object_path)
+        except S3Error as e:
+            if e.code == 'NoSuchKey':
+                return False
+            raise
+
+        print(f'Restoring environment {env_key} from snapshot')
+        with tempfile.TemporaryDirectory(dir=self.cache_dir) as tmp_dir:
+            snapshot_path = os.path.join(tmp_dir, 'env.tar.gz')
+            object_storage.fget_object(object_path, snapshot_path)
+            with tarfile.open(snapshot_path, 'r:gz') as tar:
+                # Virtualenvs link to the system Python with absolute symlinks
+                extract_filter = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+                tar.extractall(self.venv_dir, **extract_filter)
+
+        self.relocate_environment()
+        return True
+
+    def relocate_environment(self):
+        # Scripts of a virtualenv contain its absolute path, fix them if it was packed elsewhere
+        prefix_path = os.path.join(self.venv_dir, '.prefix')
+        with open(prefix_path, 'r') as f:
+            old_prefix = f.read().encode()
+        new_prefix = self.venv_dir.encode()
+        if old_prefix == new_prefix:
+            return
+
+        bin_dir = os.path.join(self.venv_dir, 'bin')
+        paths = [os.path.join(bin_dir, name) for name in os.listdir(bin_dir)]
+        paths.append(os.path.join(self.venv_dir, 'pyvenv.cfg'))
+        for path in paths:
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+
+            with open(path, 'rb') as f:
+                content = f.read()
+            if old_prefix in content and b'\0' not in content:
+                with open(path, 'wb') as f:
+                    f.write(content.replace(old_prefix, new_prefix))
+
+    def upload_environment(self, env_key: str):
+        object_path = f'envs/{env_key}.tar.gz'
+        try:
+            object_storage.stat_object(object_path)
+            return  # Uploaded already
+        except S3Error as e:
+            if e.code != 'NoSuchKey':
+                raise
+
+        with open(os.path.join(self.venv_dir, '.prefix'), 'w') as f:
+            f.write(self.venv_dir)
+
+        with tempfile.TemporaryDirectory(dir=self.cache_dir) as tmp_dir:
+            snapshot_path = os.path.join(tmp_dir, 'env.tar.gz')
+            with tarfile.open(snapshot_path, 'w:gz', compresslevel=1) as tar:
+                for name in os.listdir(self.venv_dir):
+                    if name != '.ready':
+                        tar.add(os.path.join(self.venv_dir, name), arcname=name)
+            object_storage.fput_object(object_path, snapshot_path)
+
+        print(f'Uploaded snapshot of environment {env_key}')
+
+    def is_installed(self, archive_key: str | None, env_key: str | None) -> bool:
+        return (
+            self.is_extracted(archive_key)
+            and env_key is not None
+            and os.path.exists(os.path.join(self.cache_dir, 'envs', env_key, '.ready'))
         )
 
-        # Copy init.py to venv
+    def is_extracted(self, archive_key: str | None) -> bool:
+        return archive_key is not None and os.path.exists(os.path.join(self.cache_dir, 'artifacts', archive_key))
+
+    def read_index(self) -> dict:
         try:
-            shutil.copytree(self.template_dir, self.venv_dir, dirs_exist_ok=True)
-        except FileExistsError:
-            pass
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def write_index(self, index: dict):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        tmp_path = f'{self.index_path}.{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def start_replicas(self):
+        deadline = time.monotonic() + MODEL_LOAD_TIMEOUT
+
+        # The first replica reports how many replicas the model wants, the others are loaded in parallel
+        self.replicas = [self.start_replica(0)]
+        self.replicas[0].wait_ready(deadline)
+
+        forks = self.replicas[0].settings.get('forks', [])
+        if forks:
+            # Zygote mode, the first replica forked the others after loading the model
+            self.replicas += [Replica(None, fork['run_dir'], fork['pid']) for fork in forks]
+        else:
+            count = max(int(self.replicas[0].settings.get('replicas', 1)), 1)
+            self.replicas += [self.start_replica(index) for index in range(1, count)]
 
-    def start_model_worker(self):
+        for replica in self.replicas[1:]:
+            replica.wait_ready(deadline)
 
-        self.process = subprocess.Popen(
+    def start_replica(self, index: int) -> Replica:
+        replica = Replica(
             [
                 os.path.join(self.venv_dir, 'bin', 'python'),
-                os.path.join(self.venv_dir, "init.py")
+                os.path.join(self.app_dir, "init.py")
             ],
-            cwd=self.venv_dir,
+            os.path.join(self.run_dir, f'replica_{index}'),
         )
+        replica.start()
+        return replica
+
+    def supervise(self):
+        while True:
+            self.check_now.wait(HEALTH_CHECK_INTERVAL)
+            self.check_now.clear()
+            if self.stopping.is_set():
+                return
+
+            for index, replica in enumerate(self.replicas):
+                if replica.ready:
+                    failure = replica.check()
+                    if failure and not self.stopping.is_set():
+                        self.fail(index, failure)
+
+            for index, replica in enumerate(self.replicas):
+                if self.zygote and index > 0:
+                    break
+                if not replica.ready and time.monotonic() >= self.restart_at[index] and not self.stopping.is_set():
+                    self.restart(index)
+
+    def fail(self, index: int, failure: str):
+        print(f'Model {self.model.id} replica {index} failed: {failure}')
+        if self.zygote:
+            index, failed = 0, self.replicas
+        else:
+            failed = [self.replicas[index]]
+
+        for replica in failed:
+            replica.fail(failure)
+        for replica in failed:
+            replica.stop()
+
+        if time.monotonic() - self.replicas[index].started_at > RESTART_BACKOFF_MAX:
+            # It ran for a while, this is not a crash loop
+            self.failures[index] = 0
+        backoff = min(RESTART_BACKOFF * 2 ** self.failures[index], RESTART_BACKOFF_MAX)
+        self.restart_at[index] = time.monotonic() + backoff
+        self.failures[index] += 1
+
+    def restart(self, index: int):
+        print(f'Restarting model {self.model.id} replica {index}')
+        try:
+            if self.zygote:
+                self.start_replicas()
+            else:
+                self.replicas[index] = self.start_replica(index)
+                self.replicas[index].wait_ready(time.monotonic() + MODEL_LOAD_TIMEOUT)
+        except Exception as e:
+            self.fail(index, str(e))
 
-    def preprocess(self, argument_infos: list[models.InputArgs]) -> bytes:
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        local_arguments_dir_path = tempfile.mkdtemp(prefix='ais_')
+        if self.stopping.is_set():
+            # Stopped while restarting
+            for replica in self.replicas:
+                replica.stop()
+
+    def preprocess(self, argument_infos: list[models.InputArgs],
+                   progress: ProgressCallback | None = None) -> bytearray:
+        local_arguments_dir_path = input_cache.make_args_dir()
         sep = common.SEPARATOR.decode()
         arg_paths = []
 
@@ -105,105 +617,84 @@ class ModelWorker:
                 extension = extension.replace(sep, '_')
                 file_name = f'{arg.index}{extension}'
                 local_argument_path = os.path.join(local_arguments_dir_path, file_name)
-                object_storage.fget_object(arg.value, local_argument_path)
+                input_cache.fetch(arg.value, local_argument_path)
                 arg_paths.append(local_argument_path)
 
         local_argument_paths = sep.join(arg_paths)
 
-        for i in range(3):
-            try:
-                sock.connect(self.socket_path)
-            except (ConnectionRefusedError, FileNotFoundError):
-                delay = 2 ** i
-                print(f'Connection refused, retrying in {delay}')
-                time.sleep(delay)
-            else:
-                break
-
-        msg = common.CMD_PREPROCESS + common.SEPARATOR + local_argument_paths.encode()
-
-        # TODO: Handle large files
         try:
-            sock.sendall(msg)
-            resp, arg = sock.recv(1000000).split(common.SEPARATOR, 1)
-        except Exception as e:
-            error_path = os.path.join(self.venv_dir, 'error.txt')
-            if os.path.exists(error_path):
-                # Check error.txt
-                with open(os.path.join(self.venv_dir, 'error.txt'), 'r') as f:
-                    error = f.read()
-                raise RuntimeError(error)
-            else:
-                raise e
-
-        shutil.rmtree(local_arguments_dir_path)
-
-        if resp == common.RESP_ERR:
-            raise RuntimeError(arg.decode())
-
-        return arg
+            return self.track(self.request(common.CMD_PREPROCESS, local_argument_paths.encode(), progress))
+        finally:
+            shutil.rmtree(local_arguments_dir_path)
 
-    def inference(self, encoded_inputs: bytes) -> bytes:
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        for i in range(3):
-            try:
-                sock.connect(self.socket_path)
-            except ConnectionRefusedError:
-                delay = 2 ** i
-                print(f'Connection refused, retrying in {delay}')
-                time.sleep(delay)
-            else:
-                break
-
-        msg = common.CMD_INFERENCE + common.SEPARATOR + encoded_inputs
-
-        sock.sendall(msg)
-
-        resp, arg = sock.recv(10000).split(common.SEPARATOR, 1)
-        if resp == common.RESP_ERR:
-            raise RuntimeError(arg.decode())
-
-        return arg
-
-    def postprocess(self, job: models.Job, encoded_outputs: bytes) -> str:
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        for i in range(3):
-            try:
-                sock.connect(self.socket_path)
-            except ConnectionRefusedError:
-                delay = 2 ** i
-                print(f'Connection refused, retrying in {delay}')
-                time.sleep(delay)
-            else:
-                break
-
-        msg = common.CMD_POSTPROCESS + common.SEPARATOR + encoded_outputs
-
-        sock.sendall(msg)
+    def inference(self, encoded_inputs: bytes | bytearray, progress: ProgressCallback | None = None) -> bytearray:
+        try:
+            return self.track(self.request(common.CMD_INFERENCE, encoded_inputs, progress))
+        finally:
+            self.release(encoded_inputs)
 
-        resp, arg = sock.recv(10000).split(common.SEPARATOR, 1)
-        if resp == common.RESP_ERR:
-            raise RuntimeError(arg.decode())
+    def postprocess(self, job: models.Job, encoded_outputs: bytes | bytearray,
+                    progress: ProgressCallback | None = None) -> str:
+        try:
+            result_local_path = self.request(common.CMD_POSTPROCESS, encoded_outputs, progress).decode()
+        finally:
+            self.release(encoded_outputs)
 
-        result_local_path = arg.decode()
         result_object_path = f'results/{job.id}'
-        object_storage.fput_object(result_object_path, result_local_path)
+        # Served with the type of the RESULT_SUFFIX the model declared
+        content_type, _ = mimetypes.guess_type(result_local_path)
+        object_storage.fput_object(result_object_path, result_local_path, content_type or 'application/octet-stream')
         os.unlink(result_local_path)
 
         return result_object_path
 
-    def update_progress(self):
-        progress_path = os.path.join(self.venv_dir, "progress.txt")
+    def request(self, command: int, payload: bytes | bytearray,
+                progress: ProgressCallback | None = None) -> bytearray:
+        request_id = next(self.request_ids)
 
-        for _ in range(3):  # Try 3 times
-            try:
-                with open(progress_path, "r") as file:
-                    first_line = file.readline().strip()
-                    return first_line
-            except FileNotFoundError:
-                return None
-            except IOError:
-                time.sleep(0.5)
+        with self.lock:
+            replicas = [replica for replica in self.replicas if replica.ready]
+            if not replicas:
+                failure = next((replica.failure for replica in self.replicas if replica.failure), None)
+                raise RuntimeError(f'Model {self.model.id} has no running replica, last failure: {failure}')
+            replica = min(replicas, key=lambda replica: replica.pending)
+            replica.pending += 1
+
+        try:
+            frame = replica.request(command, payload, request_id, progress)
+        except Exception:
+            # The connection failed, let the supervisor check the replica right away
+            self.check_now.set()
+            raise
+        finally:
+            with self.lock:
+                replica.pending -= 1
+
+        if frame.request_id != request_id:
+            raise RuntimeError(f'Unexpected response {frame.request_id} for request {request_id}')
+
+        if frame.status == common.RESP_ERR:
+            raise RuntimeError(frame.payload.decode())
+
+        return frame.payload
+
+    def track(self, encoded: bytearray) -> bytearray:
+        # The received buffer is passed on as is, tensors are never copied after the receive
+        segment_path = common.shm_segment_path(encoded)
+        if segment_path:
+            self.segments[segment_path] = time.monotonic()
+        return encoded
+
+    def release(self, encoded: bytes | bytearray):
+        segment_path = common.shm_segment_path(encoded)
+        if segment_path:
+            self.unlink_segment(segment_path)
+
+    def unlink_segment(self, segment_path: str):
+        # The model process keeps its mapping, only the name is removed
+        self.segments.pop(segment_path, None)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(segment_path)
 
     # TODO: Remove this
     def run_job(self, argument_path):
@@ -224,31 +715,58 @@ class ModelWorker:
 
         return output_path
 
+    def memory_usage(self) -> int:
+        return sum(replica.memory_usage() for replica in self.replicas)
+
+    def has_pending_segments(self) -> bool:
+        # Outputs of a stage whose next stage hasn't run yet, stopping would unlink them.
+        # Older ones belong to jobs lost between stages, nothing else would unlink them.
+        now = time.monotonic()
+        for segment_path, tracked_at in list(self.segments.items()):
+            if now - tracked_at >= SEGMENT_TIMEOUT:
+                self.unlink_segment(segment_path)
+        return bool(self.segments)
+
     def stop(self):
-        print(f'Killing model {self.model.id}')
-        self.process.kill()
-        self.process.terminate()
+        print(f'Stopping model {self.model.id}')
+        self.stopping.set()
+        self.check_now.set()
+        for replica in self.replicas:
+            replica.stop()
+
+        for segment_path in list(self.segments):
+            self.unlink_segment(segment_path)
+
+    @property
+    def fused(self) -> bool:
+        return self.replicas[0].settings.get('fused', False)
+
+    @property
+    def cache_dir(self):
+        return appdirs.user_cache_dir('ais_')
 
     @property
-    def venv_dir(self):
+    def index_path(self):
+        module_key = hashlib.sha1(self.model.module_path.encode()).hexdigest()
         return os.path.join(
-            appdirs.user_cache_dir('ais_'),
-            'venvs',
-            f'model_{self.model.id}',
+            self.cache_dir,
+            'index',
+            f'{module_key}.json',
         )
 
     @property
     def model_dir(self):
         return os.path.join(
-            self.venv_dir,
+            self.app_dir,
             'model',
         )
 
     @property
-    def socket_path(self):
+    def run_dir(self):
         return os.path.join(
-            self.venv_dir,
-            common.SOCK_NAME,
+            self.cache_dir,
+            'runs',
+            f'model_{self.model.id}',
         )
 
     @property
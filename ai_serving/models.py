@@ -35,6 +35,14 @@ class JobStatus(enum.Enum):
     FAILED = 'failed'
 
 
+class Batch(Base):
+    __tablename__ = 'batches'
+
+    id: Mapped[int] = mapped_column(nullable=False, primary_key=True, index=True)
+    created_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), nullable=False, server_default='now()')
+    updated_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), nullable=False, server_default='now()')
+
+
 class Job(Base):
     __tablename__ = 'jobs'
 
@@ -45,6 +53,7 @@ class Job(Base):
     status: Mapped[JobStatus] = mapped_column(default=JobStatus.PENDING, index=True)
     progress: Mapped[str | None] = mapped_column()
     model_id = mapped_column(ForeignKey(Model.id), index=True)
+    batch_id: Mapped[int | None] = mapped_column(ForeignKey(Batch.id), index=True)
     result_path: Mapped[str | None] = mapped_column()
 
     failed_log: Mapped[str | None] = mapped_column()
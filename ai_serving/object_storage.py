@@ -1,6 +1,12 @@
 import os
+import tempfile
 
+from concurrent.futures import ThreadPoolExecutor
+
+import certifi
+import urllib3
 from minio import Minio
+from minio.error import S3Error, ServerError
 
 
 MINIO_HOST = os.getenv('MINIO_HOST', 'localhost:9000')
@@ -8,12 +14,28 @@ MINIO_ACCESS_KEY = os.getenv('MINIO_ACCESS_KEY', 'root')
 MINIO_SECRET_KEY = os.getenv('MINIO_SECRET_KEY', 'password')
 MINIO_SECURE = os.getenv('MINIO_INSECURE', 'false').lower() != 'true'
 MINIO_BUCKET = os.getenv('MINIO_BUCKET', 'ais')
+# Objects larger than a part are uploaded and downloaded in parts of this size,
+# by this many threads per transfer. Parts can't be smaller than 5 MB.
+PART_SIZE = int(os.getenv('AIS_OBJECT_PART_SIZE_MB', '16')) * 1024 * 1024
+TRANSFER_THREADS = int(os.getenv('AIS_OBJECT_TRANSFER_THREADS', '4'))
+# Connections kept open to object storage, shared by all threads and transfers of the process
+POOL_SIZE = int(os.getenv('AIS_OBJECT_POOL_SIZE', '32'))
+
+# The client's defaults except for the pool size, which is 10
+http_client = urllib3.PoolManager(
+    timeout=urllib3.Timeout(connect=300, read=300),
+    maxsize=POOL_SIZE,
+    cert_reqs='CERT_REQUIRED',
+    ca_certs=os.getenv('SSL_CERT_FILE') or certifi.where(),
+    retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+)
 
 minio_cli = Minio(
     MINIO_HOST,
     access_key=MINIO_ACCESS_KEY,
     secret_key=MINIO_SECRET_KEY,
     secure=MINIO_SECURE,
+    http_client=http_client,
 )
 
 # Ensure that the bucket exists
@@ -27,29 +49,120 @@ def put_object(path, file):
         path,
         file,
         length=-1,
-        part_size=100_000_000,
+        part_size=PART_SIZE,
+        num_parallel_uploads=TRANSFER_THREADS,
     )
 
 
-def fput_object(path, filepath):
+def fput_object(path, filepath, content_type='application/octet-stream'):
     return minio_cli.fput_object(
         MINIO_BUCKET,
         path,
         filepath,
-        part_size=100_000_000,
+        content_type=content_type,
+        part_size=PART_SIZE,
+        num_parallel_uploads=TRANSFER_THREADS,
     )
 
 
-def get_object(path):
+def get_object(path, offset=0, length=0, headers=None):
+    # length 0 reads to the end of the object
     return minio_cli.get_object(
         MINIO_BUCKET,
         path,
+        offset=offset,
+        length=length,
+        request_headers=headers,
     )
 
 
-def fget_object(path, filepath):
-    return minio_cli.fget_object(
+def stat_object(path):
+    return minio_cli.stat_object(
+        MINIO_BUCKET,
+        path,
+    )
+
+
+def object_exists(path):
+    try:
+        stat_object(path)
+    except S3Error as e:
+        if e.code == 'NoSuchKey':
+            return False
+        raise
+    return True
+
+
+def fget_object(path, filepath, etag=None):
+    # Downloads to a temporary file renamed to filepath once complete, in parallel
+    # ranges for objects larger than a part. With an etag, fails if the object was
+    # replaced since it was stat'ed.
+    try:
+        stat = minio_cli.stat_object(
+            MINIO_BUCKET,
+            path,
+            extra_headers=if_match(etag) if etag else None,
+        )
+    except ServerError as e:
+        if not etag or e.status_code != 412:
+            raise
+        # A HEAD response has no error body, so minio can't tell a failed precondition from
+        # other server errors. The same request as a GET raises S3Error('PreconditionFailed')
+        # like the ranged downloads do.
+        res = get_object(path, 0, 1, if_match(etag))
+        res.close()
+        res.release_conn()
+        raise
+
+    directory, filename = os.path.split(filepath)
+    fd, tmp_path = tempfile.mkstemp(prefix=f'.{filename}.', suffix='.part', dir=directory or '.')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.truncate(stat.size)
+            offsets = range(0, stat.size, PART_SIZE)
+
+            def download(offset):
+                # Ranges of another version can't end up in the file if the object is replaced meanwhile
+                download_range(path, file.fileno(), offset, min(PART_SIZE, stat.size - offset), if_match(stat.etag))
+
+            if len(offsets) > 1 and TRANSFER_THREADS > 1:
+                with ThreadPoolExecutor(TRANSFER_THREADS, thread_name_prefix='object_download') as executor:
+                    list(executor.map(download, offsets))
+            else:
+                for offset in offsets:
+                    download(offset)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return stat
+
+
+def download_range(path, fd, offset, length, headers):
+    res = get_object(path, offset, length, headers)
+    try:
+        for chunk in res.stream(1024 * 1024):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+    finally:
+        res.close()
+        res.release_conn()
+
+
+def if_match(etag):
+    return {'If-Match': f'"{etag}"'}
+
+
+def list_objects(prefix):
+    return minio_cli.list_objects(
+        MINIO_BUCKET,
+        prefix,
+        recursive=True,
+    )
+
+
+def remove_object(path):
+    return minio_cli.remove_object(
         MINIO_BUCKET,
         path,
-        filepath,
     )
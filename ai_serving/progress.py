@@ -0,0 +1,62 @@
+import os
+import threading
+import time
+
+from sqlalchemy import update
+
+from . import job_events, models
+from .database import SessionLocal
+
+# Progress reported by the models is written to the database at most this often (seconds)
+FLUSH_INTERVAL = float(os.getenv('AIS_PROGRESS_FLUSH_INTERVAL', '1'))
+
+
+# Collects progress of all running jobs and writes the latest of each job in one
+# batched UPDATE per interval, instead of a write for every report.
+class ProgressFlusher:
+
+    def __init__(self, interval: float = FLUSH_INTERVAL):
+        self.interval = interval
+        self.pending: dict[int, str] = {}  # job_id -> progress
+        self.lock = threading.Lock()
+        self.thread: threading.Thread | None = None
+
+    def update(self, job_id: int, progress: str):
+        with self.lock:
+            self.pending[job_id] = progress
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='progress_flusher', daemon=True)
+                self.thread.start()
+
+    def take(self, job_id: int) -> str | None:
+        # Progress not written yet, for the caller to write with the job's final state
+        with self.lock:
+            return self.pending.pop(job_id, None)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        if not pending:
+            return
+
+        db = SessionLocal()
+        try:
+            db.execute(
+                update(models.Job),
+                [{'id': job_id, 'progress': progress} for job_id, progress in pending.items()],
+            )
+            db.commit()
+            job_events.publish({job_id: {'progress': progress} for job_id, progress in pending.items()})
+        except Exception as e:
+            print(f'Failed to update progress of jobs {list(pending)}: {e}')
+            # Retried with the next flush unless newer progress arrived meanwhile
+            with self.lock:
+                self.pending = {**pending, **self.pending}
+        finally:
+            db.close()
@@ -0,0 +1,303 @@
+import collections
+import contextlib
+import hashlib
+import os
+import re
+import threading
+import time
+
+import redis
+
+from . import models, object_storage
+
+REDIS_URL = os.getenv('REDIS_URL')
+# Jobs with the same model and inputs as an earlier job get its result without running
+RESULT_CACHE = os.getenv('AIS_RESULT_CACHE', 'false').lower() == 'true'
+# Results are reused for this long after they were last used (seconds)
+RESULT_CACHE_TTL = int(os.getenv('AIS_RESULT_CACHE_TTL', str(7 * 24 * 60 * 60)))
+# Least recently used results are forgotten above this number
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('AIS_RESULT_CACHE_MAX_ENTRIES', '100000'))
+
+# A running job stops collecting identical jobs after this long, in case it never finishes. The
+# jobs waiting for it run themselves then (seconds)
+RUNNING_TIMEOUT = int(os.getenv('AIS_RESULT_CACHE_RUNNING_TIMEOUT', str(24 * 60 * 60)))
+
+# Workers look for waiting jobs whose running job is gone this often (seconds)
+SWEEP_INTERVAL = 60
+# Workers refresh the heartbeat of the jobs running a stage this often. A job in a running
+# status without a heartbeat for HEARTBEAT_TIMEOUT got lost with its worker (seconds)
+HEARTBEAT_INTERVAL = 15
+HEARTBEAT_TIMEOUT = 4 * HEARTBEAT_INTERVAL
+
+PREFIX = 'ais:result:'
+STATS_KEY = f'{PREFIX}stats'
+INDEX_KEY = f'{PREFIX}index'  # cache key -> last use time
+WAITING_KEY = f'{PREFIX}waiting'  # cache keys with jobs waiting for a running job
+
+# Uploads stored under the digest of their content, see main.upload_path
+UPLOAD_PATH = re.compile(r'uploads/[0-9a-f]{64}(\.[^/]*)?')
+
+# Returns the cached result, or makes the job the one running for the key, or
+# queues it behind the running job. In one step, so identical jobs submitted at
+# once run only once.
+CLAIM_SCRIPT = '''
+local result_key, running_key, followers_key, job_key = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local job_id, key, ttl, now = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+local running_timeout = ARGV[5]
+
+local result_path = redis.call('GET', result_key)
+if result_path then
+    redis.call('EXPIRE', result_key, ttl)
+    redis.call('ZADD', KEYS[6], now, key)
+    redis.call('HINCRBY', KEYS[5], 'hits', 1)
+    return {'hit', result_path}
+end
+
+if redis.call('SET', running_key, job_id, 'NX', 'EX', running_timeout) then
+    redis.call('SET', job_key, key, 'EX', running_timeout)
+    redis.call('HINCRBY', KEYS[5], 'misses', 1)
+    return {'run', false}
+end
+
+redis.call('RPUSH', followers_key, job_id)
+redis.call('EXPIRE', followers_key, running_timeout)
+redis.call('SADD', KEYS[7], key)
+redis.call('HINCRBY', KEYS[5], 'coalesced', 1)
+return {'follow', false}
+'''
+
+# Stores the result of a job that ran for a key and returns the jobs queued behind it
+FINISH_SCRIPT = '''
+local job_key, index_key, waiting_key = KEYS[1], KEYS[2], KEYS[3]
+local job_id, result_path, ttl, now = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+local max_entries, prefix = tonumber(ARGV[5]), ARGV[6]
+
+local key = redis.call('GET', job_key)
+if not key then
+    return {}
+end
+redis.call('DEL', job_key)
+
+if result_path ~= '' then
+    redis.call('SET', prefix .. key, result_path, 'EX', ttl)
+    redis.call('ZADD', index_key, now, key)
+    -- Expired entries, then the least recently used ones above the limit
+    redis.call('ZREMRANGEBYSCORE', index_key, '-inf', now - ttl)
+    local excess = redis.call('ZCARD', index_key) - max_entries
+    if excess > 0 then
+        local evicted = redis.call('ZPOPMIN', index_key, excess)
+        for i = 1, #evicted, 2 do
+            redis.call('DEL', prefix .. evicted[i])
+        end
+    end
+end
+
+local running_key, followers_key = prefix .. key .. ':running', prefix .. key .. ':followers'
+if redis.call('GET', running_key) ~= job_id then
+    return {}
+end
+local followers = redis.call('LRANGE', followers_key, 0, -1)
+redis.call('DEL', running_key, followers_key)
+redis.call('SREM', waiting_key, key)
+return followers
+'''
+
+# Makes the first job waiting for a running job that is gone the one running for the
+# key, unless the running job changed since it was seen. Returns its id, if any.
+PROMOTE_SCRIPT = '''
+local running_key, followers_key, waiting_key = KEYS[1], KEYS[2], KEYS[3]
+local key, leader_id, running_timeout, prefix = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+
+if (redis.call('GET', running_key) or '') ~= leader_id then
+    return false
+end
+
+local job_id = redis.call('LPOP', followers_key)
+if redis.call('LLEN', followers_key) == 0 then
+    redis.call('SREM', waiting_key, key)
+end
+if not job_id then
+    redis.call('DEL', running_key)
+    return false
+end
+
+redis.call('SET', running_key, job_id, 'EX', running_timeout)
+redis.call('SET', prefix .. 'job:' .. job_id, key, 'EX', running_timeout)
+return job_id
+'''
+
+client: redis.Redis | None = None
+
+
+def connect() -> redis.Redis:
+    global client
+    if client is None:
+        client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    return client
+
+
+def input_digest(argument_info: dict) -> str:
+    if argument_info['type'] == models.Type.TEXT:
+        return hashlib.sha256(argument_info['value'].encode()).hexdigest()
+    if UPLOAD_PATH.fullmatch(argument_info['value']):
+        # The path holds the digest of the content and the extension the model sees
+        return argument_info['value']
+
+    _, extension = os.path.splitext(argument_info['value'])
+    return f"{extension} {object_storage.stat_object(argument_info['value']).etag}"
+
+
+def cache_key(module_path: str, argument_infos: list[dict]) -> str:
+    # The model's archive and the inputs in the order the model gets them
+    digest = hashlib.sha256(object_storage.stat_object(module_path).etag.encode())
+    for argument_info in sorted(argument_infos, key=lambda argument_info: argument_info['index']):
+        digest.update(f"\0{argument_info['index']}\0{argument_info['type'].value}\0".encode())
+        digest.update(input_digest(argument_info).encode())
+    return digest.hexdigest()
+
+
+def claim(job_id: int, module_path: str, argument_infos: list[dict]) -> tuple[str, str | None]:
+    # ('hit', result path) for a cached result, ('run', None) if the job has to run
+    # and ('follow', None) if it gets the result of an identical running job
+    try:
+        key = cache_key(module_path, argument_infos)
+        connection = connect()
+        outcome, result_path = connection.register_script(CLAIM_SCRIPT)(
+            keys=[f'{PREFIX}{key}', running_key(key), followers_key(key), job_key(job_id), STATS_KEY, INDEX_KEY,
+                  WAITING_KEY],
+            args=[job_id, key, RESULT_CACHE_TTL, int(time.time()), RUNNING_TIMEOUT],
+        )
+    except Exception as e:
+        # The job runs as if the cache was disabled
+        print(f'Failed to look up cached result of job {job_id}: {e}')
+        return 'run', None
+
+    return outcome, result_path
+
+
+def finish(job_id: int, result_path: str | None = None) -> list[int]:
+    # Stores the result of a job that ran for its key, if it completed. Returns the
+    # identical jobs submitted meanwhile, which get the result or have to run themselves.
+    try:
+        followers = connect().register_script(FINISH_SCRIPT)(
+            keys=[job_key(job_id), INDEX_KEY, WAITING_KEY],
+            args=[job_id, result_path or '', RESULT_CACHE_TTL, int(time.time()), RESULT_CACHE_MAX_ENTRIES, PREFIX],
+        )
+    except redis.RedisError as e:
+        print(f'Failed to store cached result of job {job_id}: {e}')
+        return []
+
+    return [int(follower) for follower in followers]
+
+
+def waiting() -> list[tuple[str, int | None]]:
+    # Cache keys with jobs waiting for a running job, and the id of that job. None if
+    # it ran for longer than RUNNING_TIMEOUT.
+    connection = connect()
+    keys = list(connection.smembers(WAITING_KEY))
+    if not keys:
+        return []
+    leader_ids = connection.mget([running_key(key) for key in keys])
+    return [(key, int(leader_id) if leader_id else None) for key, leader_id in zip(keys, leader_ids)]
+
+
+def promote(key: str, leader_id: int | None) -> int | None:
+    # The running job of the key failed or got lost without releasing the jobs waiting
+    # for it. The first of them runs for the key instead, the others keep waiting.
+    job_id = connect().register_script(PROMOTE_SCRIPT)(
+        keys=[running_key(key), followers_key(key), WAITING_KEY],
+        args=[key, leader_id or '', RUNNING_TIMEOUT, PREFIX],
+    )
+    return int(job_id) if job_id else None
+
+
+def alive(job_ids: list[int]) -> set[int]:
+    # Jobs whose worker refreshed their heartbeat within HEARTBEAT_TIMEOUT
+    if not job_ids:
+        return set()
+    beats = connect().mget([heartbeat_key(job_id) for job_id in job_ids])
+    return {job_id for job_id, beat in zip(job_ids, beats) if beat}
+
+
+def beat(job_ids: list[int]):
+    pipeline = connect().pipeline(transaction=False)
+    for job_id in job_ids:
+        pipeline.set(heartbeat_key(job_id), 1, ex=HEARTBEAT_TIMEOUT)
+    pipeline.execute()
+
+
+def job_key(job_id: int) -> str:
+    return f'{PREFIX}job:{job_id}'
+
+
+def running_key(key: str) -> str:
+    return f'{PREFIX}{key}:running'
+
+
+def followers_key(key: str) -> str:
+    return f'{PREFIX}{key}:followers'
+
+
+def heartbeat_key(job_id: int) -> str:
+    return f'{PREFIX}job:{job_id}:heartbeat'
+
+
+def stats() -> dict:
+    connection = connect()
+    counts = connection.hgetall(STATS_KEY)
+    hits, misses, coalesced = (int(counts.get(name, 0)) for name in ('hits', 'misses', 'coalesced'))
+    total = hits + misses + coalesced
+    return {
+        'hits': hits,
+        'misses': misses,
+        'coalesced': coalesced,
+        # Jobs that didn't run
+        'hit_rate': (hits + coalesced) / total if total else 0.0,
+        'entries': connection.zcard(INDEX_KEY),
+    }
+
+
+# Keeps the heartbeat of the jobs running a stage in this process, so the sweeper can
+# tell a job lost with its worker from one that is still running
+class Heartbeat:
+
+    def __init__(self, interval: float = HEARTBEAT_INTERVAL):
+        self.interval = interval
+        self.running: collections.Counter[int] = collections.Counter()
+        self.lock = threading.Lock()
+        self.thread: threading.Thread | None = None
+
+    @contextlib.contextmanager
+    def beating(self, job_id: int):
+        if not RESULT_CACHE:
+            yield
+            return
+
+        with self.lock:
+            self.running[job_id] += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='heartbeat', daemon=True)
+                self.thread.start()
+        try:
+            # Before the job's status changes to a running one
+            self.beat([job_id])
+            yield
+        finally:
+            with self.lock:
+                self.running[job_id] -= 1
+                if not self.running[job_id]:
+                    del self.running[job_id]
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                job_ids = list(self.running)
+            if job_ids:
+                self.beat(job_ids)
+
+    def beat(self, job_ids: list[int]):
+        try:
+            beat(job_ids)
+        except redis.RedisError as e:
+            print(f'Failed to refresh the heartbeat of jobs {job_ids}: {e}')
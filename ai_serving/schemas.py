@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from .models import JobStatus, Type
 
@@ -33,6 +33,14 @@ class Job(ItemBase):
         from_attributes = True
 
 
+class JobEvent(BaseModel):
+    id: int
+    status: JobStatus
+    progress: str | None = None
+    result_path: str | None = None
+    failed_log: str | None = None
+
+
 class ArgInfo(BaseModel):
     value: str
     type: Type
@@ -44,5 +52,37 @@ class JobCreate(BaseModel):
     argument_infos: list[ArgInfo]
 
 
+class BatchCreated(BaseModel):
+    id: int
+    job_ids: list[int]
+
+
+class Batch(ItemBase):
+    id: int
+    total: int
+    # Number of jobs in each status
+    statuses: dict[JobStatus, int]
+
+
+class ResultCacheStats(BaseModel):
+    hits: int
+    misses: int
+    # Jobs that got the result of an identical job running at the same time
+    coalesced: int
+    hit_rate: float
+    entries: int
+
+
 class ArgsCreated(BaseModel):
     argument_infos: list[ArgInfo]
+
+
+class UploadDigest(BaseModel):
+    # SHA-256 of the file content, hex encoded
+    sha256: str = Field(pattern='^[0-9a-f]{64}$')
+    filename: str
+
+
+class UploadsFound(BaseModel):
+    # Object path of each file in the order asked, None if the file has to be uploaded
+    paths: list[str | None]
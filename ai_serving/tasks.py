@@ -2,165 +2,377 @@ import os
 import threading
 import time
 
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 from celery import Celery
+from celery.concurrency import get_implementation, prefork
+from celery.signals import (celeryd_after_setup, worker_init, worker_process_init, worker_process_shutdown,
+                            worker_shutdown)
 from celery.utils.log import get_task_logger
+from sqlalchemy import update
+from sqlalchemy.orm import Session
 
-from . import models
+from . import job_events, models, result_cache, tensor_store
 from .database import SessionLocal
-from .model_worker import ModelWorker
+from .model_cache import ModelCache
+from .model_worker import ModelWorker, ProgressCallback
+from .progress import ProgressFlusher
 
-EncodedInputs = bytes
+# Buffers received from the model process, or read from the tensor store
+EncodedInputs = bytes | bytearray
+EncodedOutputs = bytes | bytearray
+TensorHandle = str
 
 
 REDIS_URL = os.getenv('REDIS_URL')
+# Models loaded when the worker starts: "all" or comma separated model ids
+PRELOAD_MODELS = os.getenv('AIS_PRELOAD_MODELS', '')
+# A job in one of these is lost when its heartbeat stopped
+RUNNING_STATUSES = {models.JobStatus.PREPROCESSING, models.JobStatus.INFERENCING, models.JobStatus.POSTPROCESSING}
 
 app = Celery('tasks', backend='rpc://', broker=REDIS_URL)
 
-model_workers = {}  # model_id -> ModelWorker
-
 logger = get_task_logger(__name__)
 
 
-def load_model(model_id: int):
-    global model_workers
+@celeryd_after_setup.connect
+def setup_node_queue(sender, instance, **kwargs):
+    # Stages whose input tensors are kept on this node are routed to this queue
+    instance.app.amqp.queues.select_add(tensor_store.node_queue())
 
-    if model_id in model_workers:
-        # Model already loaded
-        return
 
-    db = SessionLocal()
-    print(f'Setting up model {model_id}')
-    model = db.query(models.Model).filter(models.Model.id == model_id).one()
-    model_workers[model_id] = ModelWorker(model)
+@worker_init.connect
+def preload_models_on_init(sender, **kwargs):
+    # Solo and thread pools run tasks in the worker process itself, load models
+    # before it starts consuming. Prefork children load them in worker_process_init.
+    if not issubclass(get_implementation(sender.pool_cls), prefork.TaskPool):
+        preload_models()
+        start_result_cache_sweeper()
 
 
-def progress_updater(job_id):
-    db = SessionLocal()
-    job = db.query(models.Job).filter(models.Job.id == job_id).one()
-    update_interval = 3
+@worker_process_init.connect
+def preload_models_on_process_init(**kwargs):
+    preload_models()
+    start_result_cache_sweeper()
 
-    while job.status not in (models.JobStatus.PENDING, models.JobStatus.FAILED, models.JobStatus.COMPLETED):
-        try:
-            updated_job_progress: str | None = model_workers[job.model_id].update_progress()
-            if updated_job_progress:
-                job = db.query(models.Job).filter(models.Job.id == job_id).one()
-                job.progress = updated_job_progress
-                db.add(job)
-                db.commit()
-                db.refresh(job)
 
-            time.sleep(update_interval)
+@worker_shutdown.connect
+@worker_process_shutdown.connect
+def stop_models(**kwargs):
+    # Model processes would otherwise outlive the worker
+    model_cache.stop_all()
+    progress_flusher.flush()
 
-            job = db.query(models.Job).filter(models.Job.id == job_id).one()
-        except Exception as e:
-            print(f"progres_updater failed: {e}")
-            break
 
-    if job.status == models.JobStatus.COMPLETED:  # For last status update
-        job = db.query(models.Job).filter(models.Job.id == job_id).one()
-        job.progress = updated_job_progress
-        db.add(job)
-        db.commit()
-        db.refresh(job)
+def preload_models():
+    if not PRELOAD_MODELS:
+        return
 
+    db = SessionLocal()
+    query = db.query(models.Model.id)
+    if PRELOAD_MODELS != 'all':
+        model_ids = [int(model_id) for model_id in PRELOAD_MODELS.split(',')]
+        query = query.filter(models.Model.id.in_(model_ids))
+    model_ids = [model_id for model_id, in query.all()]
+    db.close()
+
+    def preload(model_id: int):
+        try:
+            model_cache.get(model_id)
+        except Exception:
+            logger.exception(f'Failed to preload model {model_id}')
 
-@app.task
-def preprocess(job_id: int):
+    # Environments are installed and models loaded in parallel
+    with ThreadPoolExecutor(max_workers=max(len(model_ids), 1), thread_name_prefix='preload') as executor:
+        list(executor.map(preload, model_ids))
+
+
+def load_model(model_id: int) -> ModelWorker:
     db = SessionLocal()
-    print(f'Preprocessing job {job_id}')
-    job = db.query(models.Job).filter(models.Job.id == job_id).one()
+    print(f'Setting up model {model_id}')
+    model = db.query(models.Model).filter(models.Model.id == model_id).one()
+    db.close()
+    return ModelWorker(model)
+
 
+# Loaded models, stopped when idle or over the memory budget and loaded again on demand
+model_cache = ModelCache(load_model)
+# Progress reported by the models of all running jobs
+progress_flusher = ProgressFlusher()
+# Tells the result cache sweeper which jobs are still running a stage
+heartbeat = result_cache.Heartbeat()
+
+
+def run_preprocess(db: Session, job: models.Job) -> EncodedInputs:
+    print(f'Preprocessing job {job.id}')
     job.status = models.JobStatus.PREPROCESSING
-    db.add(job)
-    db.commit()
+    commit_job(db, job)
 
     try:
-        # Ensure model is loaded
-        load_model(job.model_id)
-
         input_args: list[models.InputArgs] = (
             db.query(models.InputArgs)
-            .filter(models.InputArgs.job_id == job_id)
+            .filter(models.InputArgs.job_id == job.id)
             .order_by(models.InputArgs.index).all()
         )
 
-        launch_progress_updater(job_id)
-
-        inputs = model_workers[job.model_id].preprocess(input_args)
+        # Loads the model if needed and keeps it from being evicted meanwhile
+        with model_cache.use(job.model_id) as model_worker:
+            inputs = model_worker.preprocess(input_args, progress_reporter(job))
     except Exception as e:
-        job.status = models.JobStatus.FAILED
-        job.failed_log = str(e)
-        db.add(job)
-        db.commit()
+        fail_job(db, job, e)
         raise e
 
     job.status = models.JobStatus.PREPROCESSED
-    db.add(job)
-    db.commit()
-
-    inference.delay(job_id, inputs)
+    commit_job(db, job)
 
+    return inputs
 
-@app.task
-def inference(job_id: int, inputs: EncodedInputs):
-    db = SessionLocal()
-    print(f'Inferencing job {job_id}')
-    job = db.query(models.Job).filter(models.Job.id == job_id).one()
 
+def run_inference(db: Session, job: models.Job, inputs: EncodedInputs) -> EncodedOutputs:
+    print(f'Inferencing job {job.id}')
     job.status = models.JobStatus.INFERENCING
-    db.add(job)
-    db.commit()
+    commit_job(db, job)
 
     try:
-        # Ensure model is loaded
-        load_model(job.model_id)
-
-        outputs = model_workers[job.model_id].inference(inputs)
+        with model_cache.use(job.model_id) as model_worker:
+            outputs = model_worker.inference(inputs, progress_reporter(job))
     except Exception as e:
-        job.status = models.JobStatus.FAILED
-        job.failed_log = str(e)
-        db.add(job)
-        db.commit()
+        fail_job(db, job, e)
         raise e
 
     job.status = models.JobStatus.INFERENCED
+    commit_job(db, job)
+
+    return outputs
+
+
+def run_postprocess(db: Session, job: models.Job, outputs: EncodedOutputs):
+    print(f'Postprocessing job {job.id}')
+    job.status = models.JobStatus.POSTPROCESSING
+    commit_job(db, job)
+
+    try:
+        with model_cache.use(job.model_id) as model_worker:
+            result_path = model_worker.postprocess(job, outputs, progress_reporter(job))
+    except Exception as e:
+        fail_job(db, job, e)
+        raise e
+
+    job.status = models.JobStatus.COMPLETED
+    job.result_path = result_path
+    commit_job(db, job, progress_flusher.take(job.id))
+
+    cleanup_tensors(job.id)
+    if result_cache.RESULT_CACHE:
+        complete_followers(db, result_cache.finish(job.id, result_path), result_path)
+
+
+def progress_reporter(job: models.Job) -> ProgressCallback:
+    job_id = job.id
+
+    def report(progress: str):
+        progress_flusher.update(job_id, progress)
+
+    return report
+
+
+def commit_job(db: Session, job: models.Job, progress: str | None = None):
+    # Progress the flusher didn't write yet is written with the final state of the job
+    if progress:
+        job.progress = progress
     db.add(job)
+
+    # Read before the commit expires the attributes
+    fields = job_events.job_fields(job)
+    if progress:
+        fields['progress'] = progress
+    changes = {job.id: fields}
+    db.commit()
+
+    # Watchers of the job are notified through Redis, not by polling the database
+    job_events.publish(changes)
+
+
+def fail_job(db: Session, job: models.Job, e: Exception):
+    job.status = models.JobStatus.FAILED
+    job.failed_log = str(e)
+    commit_job(db, job, progress_flusher.take(job.id))
+
+    cleanup_tensors(job.id)
+    if result_cache.RESULT_CACHE:
+        # Identical jobs waiting for this one run on their own
+        for follower_id in result_cache.finish(job.id):
+            preprocess.delay(follower_id)
+
+
+def cleanup_tensors(job_id: int):
+    # The job is completed or failed already, a storage error must not replace its outcome
+    try:
+        tensor_store.cleanup(job_id)
+    except Exception:
+        logger.exception(f'Failed to clean up intermediate tensors of job {job_id}')
+
+
+def complete_followers(db: Session, follower_ids: list[int], result_path: str):
+    # Identical jobs submitted while this one ran get its result
+    if not follower_ids:
+        return
+
+    db.execute(
+        update(models.Job),
+        [{'id': job_id, 'status': models.JobStatus.COMPLETED, 'result_path': result_path} for job_id in follower_ids],
+    )
     db.commit()
 
-    postprocess.delay(job_id, outputs)
+    fields = {'status': models.JobStatus.COMPLETED.value, 'result_path': result_path, 'failed_log': None}
+    job_events.publish({job_id: fields for job_id in follower_ids})
+
+
+def start_result_cache_sweeper():
+    if result_cache.RESULT_CACHE:
+        threading.Thread(target=sweep_result_cache_forever, name='result_cache_sweeper', daemon=True).start()
+
+
+def sweep_result_cache_forever():
+    while True:
+        time.sleep(result_cache.SWEEP_INTERVAL)
+        try:
+            sweep_result_cache()
+        except Exception:
+            logger.exception('Failed to sweep the result cache')
+
+
+def sweep_result_cache():
+    # Jobs wait for an identical running job until it releases them. A job that got lost
+    # (its worker was killed during a stage) or ended without releasing them is replaced by
+    # the first of them.
+    waiting = result_cache.waiting()
+    if not waiting:
+        return
+
+    db = SessionLocal()
+    try:
+        leader_ids = [leader_id for _, leader_id in waiting if leader_id is not None]
+        leaders = {job.id: job for job in db.query(models.Job).filter(models.Job.id.in_(leader_ids))}
+        # Read after the statuses, a stage starts beating before it changes the status
+        alive = result_cache.alive([job.id for job in leaders.values() if job.status in RUNNING_STATUSES])
+
+        for key, leader_id in waiting:
+            leader = leaders.get(leader_id)
+            if leader is not None and leader.status == models.JobStatus.COMPLETED:
+                follower_ids = result_cache.finish(leader.id, leader.result_path)
+                if follower_ids:
+                    complete_followers(db, follower_ids, leader.result_path)
+                    continue
+            elif leader is not None and leader.status in RUNNING_STATUSES:
+                if leader.id in alive:
+                    continue
+            elif leader is not None and leader.status != models.JobStatus.FAILED:
+                # Queued for its next stage
+                continue
+
+            # Expired after RUNNING_TIMEOUT, deleted, failed, lost or finished meanwhile
+            job_id = result_cache.promote(key, leader_id)
+            if job_id is not None:
+                print(f'Running job {job_id} on its own, the identical job it waited for is gone')
+                preprocess.delay(job_id)
+    finally:
+        db.close()
 
 
 @app.task
-def postprocess(job_id: int, outputs: list[np.ndarray]):
+def preprocess(job_id: int):
     db = SessionLocal()
-    print(f'Postprocessing job {job_id}')
     job = db.query(models.Job).filter(models.Job.id == job_id).one()
 
-    job.status = models.JobStatus.POSTPROCESSING
-    db.add(job)
-    db.commit()
+    with heartbeat.beating(job_id):
+        inputs = run_preprocess(db, job)
+
+        if is_fused(db, job):
+            # Run the remaining stages in this task, intermediate arrays never go through the broker
+            outputs = run_inference(db, job, inputs)
+            run_postprocess(db, job, outputs)
+        else:
+            pass_on(db, job, inference, inputs)
+
+
+@app.task
+def inference(job_id: int, inputs_handle: TensorHandle):
+    db = SessionLocal()
+    job = db.query(models.Job).filter(models.Job.id == job_id).one()
+
+    with heartbeat.beating(job_id):
+        inputs = load_tensors(db, job, inputs_handle)
+        outputs = run_inference(db, job, inputs)
+        try:
+            tensor_store.delete(inputs_handle)
+        except Exception:
+            # Removed with the job's other tensors once it finished
+            logger.exception(f'Failed to delete inputs of job {job_id}')
+
+        pass_on(db, job, postprocess, outputs)
+
+
+@app.task
+def postprocess(job_id: int, outputs_handle: TensorHandle):
+    db = SessionLocal()
+    job = db.query(models.Job).filter(models.Job.id == job_id).one()
+
+    with heartbeat.beating(job_id):
+        outputs = load_tensors(db, job, outputs_handle)
+        run_postprocess(db, job, outputs)
 
+
+def is_fused(db: Session, job: models.Job) -> bool:
+    # Errors between the stages fail the job too, it must not stay in a running status
+    # with identical jobs waiting for it
     try:
-        # Ensure model is loaded
-        load_model(job.model_id)
+        return model_cache.get(job.model_id).fused
+    except Exception as e:
+        fail_job(db, job, e)
+        raise e
+
+
+def pass_on(db: Session, job: models.Job, task, data: EncodedInputs | EncodedOutputs):
+    try:
+        handle = store_tensors(db, job, data)
+        enqueue_stage(db, job, task, handle)
+    except Exception:
+        # The next stage would have unlinked the shared memory segments of the arrays
+        release_segments(job, data)
+        raise
+
 
-        result_path = model_workers[job.model_id].postprocess(job, outputs)
+def release_segments(job: models.Job, data: EncodedInputs | EncodedOutputs):
+    try:
+        # Segments of a model that was stopped meanwhile are unlinked already
+        model_worker = model_cache.loaded(job.model_id)
+        if model_worker:
+            model_worker.release(data)
+    except Exception:
+        logger.exception(f'Failed to release shared memory of job {job.id}')
+
+
+def enqueue_stage(db: Session, job: models.Job, task, handle: TensorHandle):
+    # Only a handle to the stored tensors goes through the broker
+    try:
+        task.apply_async((job.id, handle), queue=tensor_store.queue(handle))
     except Exception as e:
-        job.status = models.JobStatus.FAILED
-        job.failed_log = str(e)
-        db.add(job)
-        db.commit()
+        fail_job(db, job, e)
         raise e
 
-    job.status = models.JobStatus.COMPLETED
-    job.result_path = result_path
-    db.add(job)
-    db.commit()
 
+def store_tensors(db: Session, job: models.Job, data: EncodedInputs | EncodedOutputs) -> TensorHandle:
+    try:
+        return tensor_store.put(job.id, data)
+    except Exception as e:
+        fail_job(db, job, e)
+        raise e
 
-def launch_progress_updater(job_id: int):
-    t = threading.Thread(target=progress_updater, args=(job_id,), name='progress_updater')
 
-    t.start()
+def load_tensors(db: Session, job: models.Job, handle: TensorHandle) -> EncodedInputs | EncodedOutputs:
+    try:
+        return tensor_store.get(handle)
+    except Exception as e:
+        fail_job(db, job, e)
+        raise e
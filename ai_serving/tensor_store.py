@@ -0,0 +1,83 @@
+import io
+import os
+import shutil
+import socket
+import uuid
+
+from . import object_storage
+
+# Where intermediate tensors of separate stage tasks are kept:
+#  local:  a directory on this node (tmpfs by default), the next stage is routed
+#          to this node's queue
+#  object: object storage, the next stage can run on any node
+TENSOR_STORE = os.getenv('AIS_TENSOR_STORE', 'local')
+TENSOR_STORE_DIR = os.getenv('AIS_TENSOR_STORE_DIR', '/dev/shm/ais_tensors')
+
+NODE = socket.gethostname()
+
+LOCAL_SCHEME = 'local://'
+OBJECT_SCHEME = 'object://'
+
+
+def node_queue(node: str = NODE) -> str:
+    return f'ais.node.{node}'
+
+
+def put(job_id: int, data: bytes | bytearray) -> str:
+    name = uuid.uuid4().hex
+
+    if TENSOR_STORE == 'local':
+        job_dir = os.path.join(TENSOR_STORE_DIR, str(job_id))
+        os.makedirs(job_dir, exist_ok=True)
+        with open(os.path.join(job_dir, name), 'wb') as f:
+            f.write(data)
+        return f'{LOCAL_SCHEME}{NODE}/{job_id}/{name}'
+
+    object_path = f'scratch/{job_id}/{name}'
+    object_storage.put_object(object_path, io.BytesIO(data))
+    return f'{OBJECT_SCHEME}{object_path}'
+
+
+def get(handle: str) -> bytes:
+    if handle.startswith(LOCAL_SCHEME):
+        with open(local_path(handle), 'rb') as f:
+            return f.read()
+
+    res = object_storage.get_object(handle.removeprefix(OBJECT_SCHEME))
+    try:
+        return res.read()
+    finally:
+        res.close()
+        res.release_conn()
+
+
+def delete(handle: str):
+    if handle.startswith(LOCAL_SCHEME):
+        path = local_path(handle)
+        if os.path.exists(path):
+            os.unlink(path)
+    else:
+        object_storage.remove_object(handle.removeprefix(OBJECT_SCHEME))
+
+
+def queue(handle: str) -> str | None:
+    # Queue of the node holding the tensor, None when any node can read it
+    if handle.startswith(LOCAL_SCHEME):
+        node = handle.removeprefix(LOCAL_SCHEME).split('/', 1)[0]
+        return node_queue(node)
+    return None
+
+
+def cleanup(job_id: int):
+    shutil.rmtree(os.path.join(TENSOR_STORE_DIR, str(job_id)), ignore_errors=True)
+
+    if TENSOR_STORE == 'object':
+        for obj in object_storage.list_objects(f'scratch/{job_id}/'):
+            object_storage.remove_object(obj.object_name)
+
+
+def local_path(handle: str) -> str:
+    node, job_id, name = handle.removeprefix(LOCAL_SCHEME).split('/')
+    if node != NODE:
+        raise RuntimeError(f'Tensor {handle} is stored on another node')
+    return os.path.join(TENSOR_STORE_DIR, job_id, name)
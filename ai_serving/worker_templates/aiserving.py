@@ -1,8 +1,9 @@
-from pathlib import Path
+from typing import Callable
 
 __all__ = ('Status', 'update_progress',)
 
-venv_dir = Path(__file__).parent.parent
+# Sends progress of the request running in the calling thread to the parent process, set by the model process
+progress_handler: Callable[[str], None] | None = None
 
 
 class Status:
@@ -13,6 +14,6 @@ class Status:
 
 
 def update_progress(status: Status, progress: int, total: int):
-    progress_path = venv_dir / "progress.txt"
-    with progress_path.open('w') as f:
-        f.write(f'{status}:{progress}:{total}')
+    # Progress reported outside of a job, e.g. in load(), is dropped
+    if progress_handler is not None:
+        progress_handler(f'{status}:{progress}:{total}')
@@ -0,0 +1,130 @@
+import collections
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+from typing import Callable, NamedTuple
+
+import numpy as np
+
+Inference = Callable[[list[np.ndarray]], list[np.ndarray]]
+ProgressSender = Callable[[str], None]
+
+
+class Request(NamedTuple):
+    inputs: list[np.ndarray]
+    key: tuple
+    size: int
+    future: Future
+    send_progress: ProgressSender | None
+
+
+# Groups concurrent inference calls into one call of the model.
+# Inputs of the grouped requests are concatenated along axis 0 and the outputs
+# are split back by the number of rows every request contributed.
+class Batcher:
+
+    def __init__(self, inference: Inference, max_batch_size: int, max_wait_ms: float):
+        self.inference = inference
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self.queue: queue.Queue[Request] = queue.Queue()
+        # Requests that didn't fit in the batch being collected
+        self.pending: collections.deque[Request] = collections.deque()
+        # Batch the model is running
+        self.batch: list[Request] = []
+
+        self.thread = threading.Thread(target=self.run, name='batcher', daemon=True)
+        self.thread.start()
+
+    def __call__(self, inputs: list[np.ndarray], send_progress: ProgressSender | None = None) -> list[np.ndarray]:
+        sizes = {len(arr) if arr.ndim else None for arr in inputs}
+        if len(sizes) != 1 or None in sizes:
+            # Can't split the outputs back without a common leading dimension. Runs on the
+            # batcher thread as a batch of its own, so the model still gets one call at a time.
+            request = Request(inputs, None, self.max_batch_size, Future(), send_progress)
+        else:
+            key = tuple((arr.shape[1:], arr.dtype.str) for arr in inputs)
+            request = Request(inputs, key, sizes.pop(), Future(), send_progress)
+
+        self.queue.put(request)
+        return request.future.result()
+
+    def run(self):
+        while True:
+            self.run_batch(self.collect())
+
+    def collect(self) -> list[Request]:
+        first = self.pending.popleft() if self.pending else self.queue.get()
+        batch = [first]
+        size = first.size
+
+        for request in list(self.pending):
+            if self.fits(first, request, size):
+                self.pending.remove(request)
+                batch.append(request)
+                size += request.size
+
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+            if self.fits(first, request, size):
+                batch.append(request)
+                size += request.size
+            else:
+                self.pending.append(request)
+
+        return batch
+
+    def fits(self, first: Request, request: Request, size: int) -> bool:
+        return request.key == first.key and size + request.size <= self.max_batch_size
+
+    def send_progress(self, progress: str):
+        # Progress the model reports on the batcher thread goes to every request of the batch
+        for request in self.batch:
+            if request.send_progress:
+                request.send_progress(progress)
+
+    def run_batch(self, batch: list[Request]):
+        self.batch = batch
+        try:
+            if len(batch) == 1:
+                results = [self.inference(batch[0].inputs)]
+            else:
+                inputs = [
+                    np.concatenate([request.inputs[i] for request in batch])
+                    for i in range(len(batch[0].inputs))
+                ]
+                results = self.split(self.inference(inputs), batch)
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        finally:
+            self.batch = []
+
+        for request, outputs in zip(batch, results):
+            request.future.set_result(outputs)
+
+    def split(self, outputs: list[np.ndarray], batch: list[Request]) -> list[list[np.ndarray]]:
+        total = sum(request.size for request in batch)
+        for output in outputs:
+            if output.ndim == 0 or len(output) != total:
+                raise ValueError(f'Batched inference returned shape {output.shape} for {total} inputs')
+
+        offsets = np.cumsum([request.size for request in batch])[:-1]
+        splits = [np.split(output, offsets) for output in outputs]
+        return [
+            [split[i] for split in splits]
+            for i in range(len(batch))
+        ]
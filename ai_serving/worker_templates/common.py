@@ -1,19 +1,203 @@
 import io
+import json
+import math
+import mmap
+import os
+import socket
+import struct
+import uuid
+
+from typing import Callable, NamedTuple
 
 import numpy as np
 
 SOCK_NAME = 'ais.sock'
 SEPARATOR = b'|'
 
-CMD_PREPROCESS = b'1'
-CMD_INFERENCE = b'2'
-CMD_POSTPROCESS = b'3'
+CMD_PREPROCESS = 1
+CMD_INFERENCE = 2
+CMD_POSTPROCESS = 3
+CMD_READY = 4
+CMD_CONFIGURE = 5
+# Health check, answered by the connection thread without running model code. The
+# response holds how long the oldest running call of each stage has been running.
+CMD_PING = 6
+# Progress of a running request, sent by the model worker before the response
+CMD_PROGRESS = 7
+
+RESP_OK = 0
+RESP_ERR = 1
+
+STAGE_NAMES = {
+    CMD_PREPROCESS: 'preprocess',
+    CMD_INFERENCE: 'inference',
+    CMD_POSTPROCESS: 'postprocess',
+}
+
+# Frame header: command, status, payload length, request id (network byte order)
+HEADER = struct.Struct('!BBQQ')
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class Frame(NamedTuple):
+    command: int
+    status: int
+    request_id: int
+    payload: bytearray
+
+
+def send_frame(sock: socket.socket, command: int, status: int, payload=b'', request_id: int = 0):
+    # payload can be a single buffer or a list of buffers sent back to back
+    buffers = payload if isinstance(payload, (list, tuple)) else [payload]
+    views = [memoryview(buffer).cast('B') for buffer in buffers]
+
+    sock.sendall(HEADER.pack(command, status, sum(view.nbytes for view in views), request_id))
+    for view in views:
+        for offset in range(0, view.nbytes, CHUNK_SIZE):
+            sock.sendall(view[offset:offset + CHUNK_SIZE])
+
+
+def recv_exact(sock: socket.socket, view: memoryview):
+    received = 0
+    while received < view.nbytes:
+        size = sock.recv_into(view[received:], min(CHUNK_SIZE, view.nbytes - received))
+        if size == 0:
+            raise ConnectionError('Socket closed by peer')
+        received += size
+
+
+def recv_frame(sock: socket.socket) -> Frame:
+    header = bytearray(HEADER.size)
+    recv_exact(sock, memoryview(header))
+    command, status, length, request_id = HEADER.unpack(header)
+
+    # Preallocate the whole payload so large tensors are read without re-growing buffers
+    payload = bytearray(length)
+    recv_exact(sock, memoryview(payload))
+    return Frame(command, status, request_id, payload)
+
+
+class Codec(NamedTuple):
+    name: str
+    magic: bytes
+    # Returns one or more buffers which are sent back to back
+    encode: Callable[[list[np.ndarray]], list]
+    decode: Callable[[bytearray], list[np.ndarray]]
+
+
+# name -> Codec, encoded data starts with the magic of its codec
+CODECS: dict[str, Codec] = {}
+DEFAULT_CODECS = ('raw', 'npz')
+
+
+def register_codec(codec: Codec):
+    CODECS[codec.name] = codec
+
+
+def encode_ndarraylist(arg: list[np.ndarray], codec: str) -> list:
+    return CODECS[codec].encode(arg)
+
+
+def decode_ndarraylist(arg: bytearray) -> list[np.ndarray]:
+    for codec in CODECS.values():
+        if arg[:len(codec.magic)] == codec.magic:
+            return codec.decode(arg)
+    if arg[:len(NPZ_EMPTY_MAGIC)] == NPZ_EMPTY_MAGIC:
+        return npz_decode(arg)
+    raise ValueError(f'Unknown tensor encoding: {bytes(arg[:8])}')
+
+
+def negotiate_codec(available: list[str], preferred: list[str] | None) -> str:
+    # available is in the model's order of preference, preferred in ours
+    for codec in preferred or available:
+        if codec in available:
+            return codec
+    # E.g. a compression library missing in the model's environment, the model's choice works
+    fallback = available[0] if available else 'raw'
+    print(f'No common tensor codec in {preferred}, model supports {available}, using {fallback}')
+    return fallback
+
+
+def align(size: int, alignment: int = 64) -> int:
+    return -(-size // alignment) * alignment
+
+
+def contiguous(arr: np.ndarray) -> np.ndarray:
+    arr = np.asarray(arr)
+    if arr.dtype.hasobject:
+        raise ValueError('Object arrays can not be encoded')
+    if not arr.flags.c_contiguous:
+        arr = arr.copy(order='C')
+    return arr
+
+
+def byte_view(arr: np.ndarray) -> memoryview:
+    # Flat view on the memory of a contiguous array
+    return memoryview(arr.reshape(-1).view(np.uint8))
+
+
+# raw: magic, header length, JSON header with dtype & shape of every array,
+# then the contiguous array buffers at 64 byte aligned offsets
+RAW_MAGIC = b'\x93AISRAW'
+RAW_HEADER = struct.Struct('!I')
+
+
+def raw_encode(arg: list[np.ndarray]) -> list:
+    arrays = [contiguous(arr) for arr in arg]
+    header = json.dumps([
+        {'dtype': np.lib.format.dtype_to_descr(arr.dtype), 'shape': arr.shape}
+        for arr in arrays
+    ]).encode()
+    prefix = RAW_MAGIC + RAW_HEADER.pack(len(header)) + header
+    buffers = [prefix]
+
+    size = len(prefix)
+    for arr in arrays:
+        padding = align(size) - size
+        buffers.append(b'\0' * padding)
+        buffers.append(byte_view(arr))
+        size += padding + arr.nbytes
+
+    return buffers
 
-RESP_OK = b'0'
-RESP_ERR = b'1'
 
+def raw_decode(arg: bytearray) -> list[np.ndarray]:
+    offset = len(RAW_MAGIC)
+    header_length, = RAW_HEADER.unpack_from(arg, offset)
+    offset += RAW_HEADER.size
+    header = json.loads(bytes(arg[offset:offset + header_length]))
+    offset += header_length
 
-def bytes_to_ndarraylist(arg: bytes) -> list[np.ndarray]:
+    arrays = []
+    for info in header:
+        offset = align(offset)
+        dtype = np.lib.format.descr_to_dtype(info['dtype'])
+        count = math.prod(info['shape'])
+        # Arrays are views on the received buffer, nothing is copied
+        arr = np.frombuffer(arg, dtype=dtype, count=count, offset=offset).reshape(info['shape'])
+        arrays.append(arr)
+        offset += arr.nbytes
+
+    return arrays
+
+
+def npz_encode(arg: list[np.ndarray]) -> list:
+    f = io.BytesIO()
+    np.savez(f, *arg)
+    return [f.getbuffer()]
+
+
+def npz_compressed_encode(arg: list[np.ndarray]) -> list:
+    f = io.BytesIO()
+    np.savez_compressed(f, *arg)
+    return [f.getbuffer()]
+
+
+# np.savez of no arrays writes an empty zip file, which starts with the end of central directory record
+NPZ_EMPTY_MAGIC = b'PK\x05\x06'
+
+
+def npz_decode(arg: bytearray) -> list[np.ndarray]:
     f = io.BytesIO(arg)
     npz = np.load(f)
     return [
@@ -22,7 +206,108 @@ def bytes_to_ndarraylist(arg: bytes) -> list[np.ndarray]:
     ]
 
 
-def ndarraylist_to_bytes(arg: list[np.ndarray]) -> bytes:
-    f = io.BytesIO()
-    np.savez_compressed(f, *arg)
-    return f.getvalue()
+def compressed_codec(name: str, magic: bytes, compress, decompress) -> Codec:
+    def encode(arg: list[np.ndarray]) -> list:
+        return [magic, compress(b''.join(raw_encode(arg)))]
+
+    def decode(arg: bytearray) -> list[np.ndarray]:
+        return raw_decode(bytearray(decompress(memoryview(arg)[len(magic):])))
+
+    return Codec(name, magic, encode, decode)
+
+
+register_codec(Codec('raw', RAW_MAGIC, raw_encode, raw_decode))
+register_codec(Codec('npz', b'PK\x03\x04', npz_encode, npz_decode))
+register_codec(Codec('npz_compressed', b'PK\x03\x04', npz_compressed_encode, npz_decode))
+
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    register_codec(compressed_codec('lz4', b'\x93AISLZ4', lz4.frame.compress, lz4.frame.decompress))
+
+try:
+    import zstandard
+except ImportError:
+    pass
+else:
+    register_codec(compressed_codec(
+        'zstd',
+        b'\x93AISZST',
+        # Compressor objects are not thread safe, stages encode concurrently
+        lambda data: zstandard.ZstdCompressor(level=1).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    ))
+
+
+# Shared memory transport: arrays live in a file under SHM_DIR and only a small
+# descriptor is sent around
+SHM_MAGIC = b'\x93AISSHM'
+SHM_DIR = os.getenv('AIS_SHM_DIR', '/dev/shm')
+
+
+def shm_encode(arg: list[np.ndarray]) -> list:
+    arrays = [contiguous(arr) for arr in arg]
+
+    offsets = []
+    size = 0
+    for arr in arrays:
+        size = align(size)
+        offsets.append(size)
+        size += arr.nbytes
+
+    segment = f'ais_{uuid.uuid4().hex}'
+    fd = os.open(os.path.join(SHM_DIR, segment), os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+    try:
+        os.ftruncate(fd, max(size, 1))
+        with mmap.mmap(fd, max(size, 1)) as buf:
+            for arr, offset in zip(arrays, offsets):
+                buf[offset:offset + arr.nbytes] = byte_view(arr)
+    finally:
+        os.close(fd)
+
+    descriptor = {
+        'segment': segment,
+        'size': size,
+        'arrays': [
+            {
+                'dtype': np.lib.format.dtype_to_descr(arr.dtype),
+                'shape': arr.shape,
+                'strides': arr.strides,
+                'offset': offset,
+            }
+            for arr, offset in zip(arrays, offsets)
+        ],
+    }
+    return [SHM_MAGIC + json.dumps(descriptor).encode()]
+
+
+def shm_decode(arg: bytearray) -> list[np.ndarray]:
+    descriptor = json.loads(bytes(arg[len(SHM_MAGIC):]))
+
+    with open(os.path.join(SHM_DIR, descriptor['segment']), 'r+b') as f:
+        # Arrays keep a reference to the mapping, it is unmapped once they are gone
+        buf = mmap.mmap(f.fileno(), max(descriptor['size'], 1))
+
+    return [
+        np.ndarray(
+            shape=tuple(info['shape']),
+            dtype=np.lib.format.descr_to_dtype(info['dtype']),
+            buffer=buf,
+            offset=info['offset'],
+            strides=tuple(info['strides']),
+        )
+        for info in descriptor['arrays']
+    ]
+
+
+def shm_segment_path(arg: bytes | bytearray) -> str | None:
+    if arg[:len(SHM_MAGIC)] != SHM_MAGIC:
+        return None
+
+    descriptor = json.loads(bytes(arg[len(SHM_MAGIC):]))
+    return os.path.join(SHM_DIR, descriptor['segment'])
+
+
+register_codec(Codec('shm', SHM_MAGIC, shm_encode, shm_decode))
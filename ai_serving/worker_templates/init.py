@@ -1,28 +1,39 @@
+import json
 import os
+import signal
 import socket
 import tempfile
+import threading
+import time
 import traceback
 
+from concurrent.futures import ThreadPoolExecutor
 from typing import TYPE_CHECKING
 
-from common import bytes_to_ndarraylist, ndarraylist_to_bytes
-from common import CMD_INFERENCE, CMD_POSTPROCESS, CMD_PREPROCESS
+from batching import Batcher
+from common import CMD_CONFIGURE, CMD_INFERENCE, CMD_PING, CMD_POSTPROCESS, CMD_PREPROCESS, CMD_PROGRESS, CMD_READY
+from common import CODECS, decode_ndarraylist, DEFAULT_CODECS, encode_ndarraylist
+from common import Frame, recv_frame, send_frame
 from common import RESP_ERR, RESP_OK
-from common import SEPARATOR, SOCK_NAME
+from common import SEPARATOR, SOCK_NAME, STAGE_NAMES
 
 if TYPE_CHECKING:
     import numpy as np
 
 
-# Open unix socket to communicate with the parent process
-sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-if os.path.exists(SOCK_NAME):
-    os.unlink(SOCK_NAME)
-sock.bind(SOCK_NAME)
-sock.listen(1)
+def remove_leftovers(run_dir: str):
+    sock_path = os.path.join(run_dir, SOCK_NAME)
+    for path in (sock_path, sock_path + '.tmp', os.path.join(run_dir, 'error.txt')):
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+remove_leftovers(os.getcwd())
 
 # Load & Initialise model
 try:
+    from model import aiserving
+    from model import main as model_main
     from model.main import inference, load, postprocess, preprocess
     load()
 except Exception as e:
@@ -32,27 +43,108 @@ except Exception as e:
         f.write(tb)
     raise e
 
+replicas = getattr(model_main, 'REPLICAS', int(os.getenv('AIS_REPLICAS', '1')))
+zygote = getattr(model_main, 'ZYGOTE', os.getenv('AIS_ZYGOTE', 'false').lower() == 'true')
+
+# In zygote mode this process forks the other replicas once the model is loaded,
+# so they share its memory copy-on-write instead of each calling load(). It
+# happens before any thread of ours is started. Each fork serves from a sibling
+# run directory, which the parent process learns from the ready message.
+forks = []
+if zygote:
+    for index in range(1, replicas):
+        replica_dir = os.path.join(os.path.dirname(os.getcwd()), f'replica_{index}')
+        os.makedirs(replica_dir, exist_ok=True)
+        remove_leftovers(replica_dir)
+
+        pid = os.fork()
+        if pid == 0:
+            forks = []
+            os.chdir(replica_dir)
+            break
+
+        forks.append({'pid': pid, 'run_dir': replica_dir})
+
+    def stop_forks(signum, frame):
+        for fork in forks:
+            try:
+                os.kill(fork['pid'], signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        os._exit(128 + signum)
+
+    if forks:
+        signal.signal(signal.SIGTERM, stop_forks)
+
+# Open unix socket to communicate with the parent process.
+# It is bound to a temporary name and renamed once listening, so the socket
+# only shows up after the model has been loaded.
+sock_path = os.path.abspath(SOCK_NAME)
+sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+sock.bind(sock_path + '.tmp')
+sock.listen()
+os.rename(sock_path + '.tmp', sock_path)
+
 
 # Change working directory because the model expects to be in the model directory
-os.chdir('model')
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model'))
 
+# Tensor codecs this process can use, in the model's order of preference.
+# The parent picks one for each connection with CMD_CONFIGURE.
+codecs = [
+    codec
+    for codec in [*getattr(model_main, 'CODECS', DEFAULT_CODECS), *CODECS]
+    if codec in CODECS
+]
+codecs = list(dict.fromkeys(codecs))
 
-def do_preprocess(arg: bytes) -> bytes:
+# Models opt in to batching inference across jobs with `BATCHING = True`
+batcher = None
+if getattr(model_main, 'BATCHING', False):
+    batcher = Batcher(
+        inference,
+        max_batch_size=getattr(model_main, 'MAX_BATCH_SIZE', int(os.getenv('AIS_MAX_BATCH_SIZE', '8'))),
+        max_wait_ms=getattr(model_main, 'MAX_BATCH_WAIT_MS', float(os.getenv('AIS_MAX_BATCH_WAIT_MS', '5'))),
+    )
+
+
+# Progress the model reports while running a stage call is sent on the call's
+# connection, tagged with its request id
+current = threading.local()
+
+
+def send_progress(progress: str):
+    send = getattr(current, 'send_progress', None)
+    if send is None and batcher and threading.current_thread() is batcher.thread:
+        send = batcher.send_progress
+    if send is not None:
+        send(progress)
+
+
+aiserving.progress_handler = send_progress
+
+
+def do_preprocess(arg: bytearray, codec: str) -> list:
     argument_paths = arg.decode()
     argument_paths_list = argument_paths.split(SEPARATOR.decode())
     inputs: list[np.ndarray] = preprocess(*argument_paths_list)
-    return ndarraylist_to_bytes(inputs)
+    return encode_ndarraylist(inputs, codec)
 
 
-def do_inference(arg: bytes) -> bytes:
-    inputs = bytes_to_ndarraylist(arg)
-    outputs: list[np.ndarray] = inference(inputs)
-    return ndarraylist_to_bytes(outputs)
+def do_inference(arg: bytearray, codec: str) -> list:
+    inputs = decode_ndarraylist(arg)
+    if batcher:
+        outputs: list[np.ndarray] = batcher(inputs, current.send_progress)
+    else:
+        outputs = inference(inputs)
+    return encode_ndarraylist(outputs, codec)
 
 
-def do_postprocess(arg: bytes) -> bytes:
-    outputs = bytes_to_ndarraylist(arg)
-    result_path = tempfile.mktemp(prefix='ais_')
+def do_postprocess(arg: bytearray, codec: str) -> bytes:
+    outputs = decode_ndarraylist(arg)
+    # Models declare the extension of their result, e.g. `RESULT_SUFFIX = '.png'`. It gives
+    # the result its content type and lets libraries that go by the extension write it.
+    result_path = tempfile.mktemp(prefix='ais_', suffix=getattr(model_main, 'RESULT_SUFFIX', ''))
     postprocess(outputs, result_path)
     return result_path.encode()
 
@@ -63,19 +155,123 @@ handlers = {
     CMD_POSTPROCESS: do_postprocess,
 }
 
-while True:
-    conn, addr = sock.accept()  # TODO: Can be async and parallel?
-    command, arg = conn.recv(100000).split(SEPARATOR, 1)  # TODO: Handle large files
+# Each stage runs on its own thread pool, so preprocess and postprocess of some
+# jobs overlap with inference of others. Model code runs concurrently only as
+# much as the worker count of a stage allows.
+executors = {
+    CMD_PREPROCESS: ThreadPoolExecutor(
+        max_workers=int(os.getenv('AIS_PREPROCESS_WORKERS', '1')),
+        thread_name_prefix='preprocess',
+    ),
+    CMD_INFERENCE: ThreadPoolExecutor(
+        # Requests wait for the batcher, which makes a single model call per batch
+        max_workers=max(
+            int(os.getenv('AIS_INFERENCE_WORKERS', '1')),
+            batcher.max_batch_size if batcher else 0,
+        ),
+        thread_name_prefix='inference',
+    ),
+    CMD_POSTPROCESS: ThreadPoolExecutor(
+        max_workers=int(os.getenv('AIS_POSTPROCESS_WORKERS', '1')),
+        thread_name_prefix='postprocess',
+    ),
+}
 
+
+# Command and start time of the call each stage thread is running. Health checks
+# report the oldest, so a call stuck in model code is noticed by the parent.
+running: dict[int, tuple[int, float]] = {}
+running_lock = threading.Lock()
+
+
+def running_ages() -> dict[str, float]:
+    # Seconds the oldest running call of each stage has been running
+    now = time.monotonic()
+    ages: dict[str, float] = {}
+    with running_lock:
+        for command, started_at in running.values():
+            name = STAGE_NAMES[command]
+            ages[name] = max(ages.get(name, 0.0), now - started_at)
+    return ages
+
+
+def handle(frame: Frame, codec: str) -> tuple[int, bytes | list]:
     try:
-        if command not in handlers:
-            raise Exception(f'Unknown command: {command}')
-        result = handlers[command](arg)
+        result = handlers[frame.command](frame.payload, codec)
     except Exception:
         tb = traceback.format_exc()
-        conn.sendall(RESP_ERR + SEPARATOR + tb.encode())
-    else:
-        print(f'result size: {len(result)}')
-        conn.sendall(RESP_OK + SEPARATOR + result)
+        return RESP_ERR, tb.encode()
+
+    return RESP_OK, result
+
+
+def serve(conn: socket.socket):
+    send_lock = threading.Lock()
+    codec = codecs[0]
+
+    def respond(frame: Frame, status: int, payload: bytes | list):
+        try:
+            with send_lock:
+                send_frame(conn, frame.command, status, payload, frame.request_id)
+        except OSError:
+            print(f'Failed to send response of request {frame.request_id}')
+
+    def run(frame: Frame, codec: str):
+        def send_progress(progress: str):
+            respond(Frame(CMD_PROGRESS, RESP_OK, frame.request_id, bytearray()), RESP_OK, progress.encode())
+
+        current.send_progress = send_progress
+        with running_lock:
+            running[threading.get_ident()] = (frame.command, time.monotonic())
+        try:
+            respond(frame, *handle(frame, codec))
+        finally:
+            with running_lock:
+                del running[threading.get_ident()]
+            current.send_progress = None
+
+    try:
+        # Tell the client the model is loaded and ready for commands
+        ready = {
+            'codecs': codecs,
+            # Run all stages of a job in one task of the parent
+            'fused': getattr(model_main, 'FUSED', os.getenv('AIS_FUSED', 'false').lower() == 'true'),
+            # Model processes the parent starts, stage calls go to the least busy one
+            'replicas': replicas,
+            # Replicas forked by this process, the parent connects to them instead of starting its own
+            'forks': forks,
+        }
+        respond(Frame(CMD_READY, RESP_OK, 0, bytearray()), RESP_OK, json.dumps(ready).encode())
+
+        while True:
+            try:
+                frame = recv_frame(conn)
+            except ConnectionError:
+                break
+
+            if frame.command == CMD_PING:
+                respond(frame, RESP_OK, json.dumps({'running': running_ages()}).encode())
+                continue
+
+            if frame.command == CMD_CONFIGURE:
+                config = json.loads(frame.payload)
+                if config['codec'] in codecs:
+                    codec = config['codec']
+                    respond(frame, RESP_OK, b'')
+                else:
+                    respond(frame, RESP_ERR, f'Unsupported codec: {config["codec"]}'.encode())
+                continue
+
+            if frame.command not in executors:
+                respond(frame, RESP_ERR, f'Unknown command: {frame.command}'.encode())
+                continue
+
+            executors[frame.command].submit(run, frame, codec)
     finally:
         conn.close()
+
+
+while True:
+    # Connections are long lived and pooled by the parent process
+    conn, addr = sock.accept()
+    threading.Thread(target=serve, args=(conn,), name='serve', daemon=True).start()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# Requests per second of the API under concurrent clients, for reads from the
+# database and for uploads to object storage.
+#
+#   python benchmarks/api.py [--url URL] [--concurrency N] [--duration S] [--upload-kb KB]
+#
+# Runs against a running API, so compare two checkouts by starting the server of each in turn.
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+import httpx
+
+
+async def client(http: httpx.AsyncClient, request, deadline: float, latencies: list[float], errors: list[str]):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            response = await request(http)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            errors.append(str(e))
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+async def bench(url: str, request, concurrency: int, duration: float):
+    latencies = []
+    errors = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as http:
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*(client(http, request, deadline, latencies, errors) for _ in range(concurrency)))
+    return latencies, errors
+
+
+def percentile(values: list[float], q: int) -> float:
+    return statistics.quantiles(values, n=100)[q - 1] if len(values) > 1 else sum(values)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--upload-kb', type=int, default=1024)
+    args = parser.parse_args()
+
+    upload = os.urandom(args.upload_kb * 1024)
+    scenarios = {
+        'read job': lambda http: http.get('/jobs/1'),
+        'list jobs': lambda http: http.get('/jobs/', params={'limit': 20}),
+        'upload': lambda http: http.post('/uploads/', files={'value_list': ('bench.bin', upload)}),
+    }
+
+    print(f'{"scenario":<10} {"req/s":>8} {"p50 ms":>8} {"p99 ms":>8} {"errors":>7}')
+    for name, request in scenarios.items():
+        latencies, errors = await bench(args.url, request, args.concurrency, args.duration)
+        print(
+            f'{name:<10} {len(latencies) / args.duration:>8.1f} {percentile(latencies, 50) * 1000:>8.1f} '
+            f'{percentile(latencies, 99) * 1000:>8.1f} {len(errors):>7}'
+        )
+        if errors:
+            print(f'  first error: {errors[0]}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
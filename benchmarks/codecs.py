@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Encode/decode throughput of the tensor codecs for realistic input shapes.
+#
+#   python benchmarks/codecs.py [codec ...]
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ai_serving', 'worker_templates'))
+
+import common  # noqa: E402, I100, I202
+
+SHAPES = [
+    ('mnist', (1, 1, 28, 28), np.float32),
+    ('imagenet', (1, 3, 224, 224), np.float32),
+    ('imagenet batch', (32, 3, 224, 224), np.float32),
+    ('ct slice', (1, 1, 512, 512), np.int16),
+    ('ct volume', (1, 1, 300, 512, 512), np.int16),
+    ('ct volume float', (1, 1, 300, 512, 512), np.float32),
+]
+MIN_TIME = 1.0
+
+
+def make_array(shape, dtype) -> np.ndarray:
+    # Smooth image-like data, random noise would make compression look worse than it is
+    rng = np.random.default_rng(0)
+    arr = np.cumsum(rng.normal(size=shape), axis=-1)
+    if np.issubdtype(dtype, np.integer):
+        arr = arr * 10
+    return arr.astype(dtype)
+
+
+def measure(func) -> float:
+    count = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed > MIN_TIME:
+            return elapsed / count
+
+
+def bench(codec: str, arrays: list[np.ndarray]):
+    nbytes = sum(arr.nbytes for arr in arrays)
+
+    def encode():
+        # Join the buffers like the socket peer receives them
+        return bytearray(b''.join(common.encode_ndarraylist(arrays, codec)))
+
+    def release(encoded):
+        segment_path = common.shm_segment_path(encoded)
+        if segment_path:
+            os.unlink(segment_path)
+
+    def encode_and_release():
+        release(encode())
+
+    encoded = encode()
+    try:
+        encode_time = measure(encode_and_release)
+        decode_time = measure(lambda: common.decode_ndarraylist(encoded))
+    finally:
+        release(encoded)
+
+    return {
+        'size': len(encoded),
+        'ratio': nbytes / len(encoded),
+        'encode': nbytes / encode_time / 1e6,
+        'decode': nbytes / decode_time / 1e6,
+    }
+
+
+def main():
+    codecs = sys.argv[1:] or list(common.CODECS)
+
+    print(f'{"shape":<20} {"size":>10} {"codec":<15} {"ratio":>7} {"encode MB/s":>12} {"decode MB/s":>12}')
+    for name, shape, dtype in SHAPES:
+        arrays = [make_array(shape, dtype)]
+        for codec in codecs:
+            result = bench(codec, arrays)
+            print(
+                f'{name:<20} {arrays[0].nbytes / 1e6:>8.2f}MB {codec:<15} {result["ratio"]:>7.2f} '
+                f'{result["encode"]:>12.1f} {result["decode"]:>12.1f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Upload and download throughput of object storage for part sizes and numbers
+# of transfer threads.
+#
+#   python benchmarks/object_storage.py [--sizes-mb MB ...] [--configs PART_MB:THREADS ...]
+#
+# Runs against the object storage configured with MINIO_HOST etc., e.g. a local
+# MinIO or `moto_server -p 9000`. 100:1 is how objects were transferred before
+# part size and threads were configurable.
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ai_serving import object_storage  # noqa: E402, I100, I202
+
+MIN_TIME = 2.0
+
+
+def measure(transfer) -> float:
+    # Seconds per transfer, repeated for at least MIN_TIME
+    count = 0
+    start = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < MIN_TIME or count == 0:
+        transfer()
+        count += 1
+    return elapsed / count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes-mb', type=int, nargs='+', default=[8, 64, 256])
+    parser.add_argument('--configs', nargs='+', default=['100:1', '16:1', '16:4', '8:8'])
+    args = parser.parse_args()
+
+    configs = [tuple(int(value) for value in config.split(':')) for config in args.configs]
+
+    print(f'{"size MB":>7} {"part MB":>7} {"threads":>7} {"upload MB/s":>11} {"download MB/s":>13}')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size_mb in args.sizes_mb:
+            path = os.path.join(tmp_dir, 'object.bin')
+            with open(path, 'wb') as f:
+                for _ in range(size_mb):
+                    f.write(os.urandom(1024 * 1024))
+            object_path = f'benchmarks/object_{size_mb}mb.bin'
+
+            for part_mb, threads in configs:
+                # 100 MB parts were 100,000,000 bytes
+                object_storage.PART_SIZE = 100_000_000 if part_mb == 100 else part_mb * 1024 * 1024
+                object_storage.TRANSFER_THREADS = threads
+                upload = measure(lambda: object_storage.fput_object(object_path, path))
+                download = measure(lambda: object_storage.fget_object(object_path, os.path.join(tmp_dir, 'got.bin')))
+                print(f'{size_mb:>7} {part_mb:>7} {threads:>7} {size_mb / upload:>11.1f} {size_mb / download:>13.1f}')
+
+            object_storage.remove_object(object_path)
+
+
+if __name__ == '__main__':
+    main()
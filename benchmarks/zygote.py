@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# Start-up time and memory of model replicas that each call load() versus
+# replicas forked from a zygote after load().
+#
+#   python benchmarks/zygote.py [--replicas N] [--weights-mb MB | --model DIR]
+#
+# --model runs a real model package, e.g. examples/imagenet, with this interpreter,
+# so its requirements must be installed. Otherwise a model holding MB of weights is used.
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ai_serving', 'worker_templates'))
+
+import common  # noqa: E402, I100, I202
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), '..', 'ai_serving', 'worker_templates')
+WEIGHTS_MODEL = '''\
+import numpy as np
+
+
+def load():
+    global weights
+    # Touch every page like loading a checkpoint does
+    weights = np.ones({size}, dtype=np.uint8)
+
+
+def preprocess(*paths):
+    return []
+
+
+def inference(inputs):
+    return inputs
+
+
+def postprocess(outputs, result_path):
+    open(result_path, 'w').close()
+'''
+
+
+def install(app_dir: str, model: str | None, weights_mb: float):
+    for name in os.listdir(TEMPLATE_DIR):
+        if name.endswith('.py') and name != 'aiserving.py':
+            shutil.copy(os.path.join(TEMPLATE_DIR, name), app_dir)
+
+    model_dir = os.path.join(app_dir, 'model')
+    if model:
+        shutil.copytree(model, model_dir)
+    else:
+        os.makedirs(model_dir)
+        with open(os.path.join(model_dir, 'main.py'), 'w') as f:
+            f.write(WEIGHTS_MODEL.format(size=int(weights_mb * 2 ** 20)))
+    open(os.path.join(model_dir, '__init__.py'), 'a').close()
+    shutil.copy(os.path.join(TEMPLATE_DIR, 'aiserving.py'), model_dir)
+
+
+def start(app_dir: str, run_dir: str, env: dict) -> subprocess.Popen:
+    os.makedirs(run_dir, exist_ok=True)
+    return subprocess.Popen(
+        [sys.executable, os.path.join(app_dir, 'init.py')],
+        cwd=run_dir,
+        env={**os.environ, **env},
+    )
+
+
+def wait_ready(process: subprocess.Popen, run_dir: str) -> dict:
+    socket_path = os.path.join(run_dir, common.SOCK_NAME)
+    while not os.path.exists(socket_path):
+        if process and process.poll() is not None:
+            raise RuntimeError(f'Model worker exited with {process.returncode}')
+        time.sleep(0.01)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        frame = common.recv_frame(sock)
+    return json.loads(frame.payload)
+
+
+def memory(pid: int) -> dict[str, int]:
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    return {
+        'rss': fields['Rss'],
+        'pss': fields['Pss'],
+        'private': fields['Private_Clean'] + fields['Private_Dirty'],
+    }
+
+
+def bench(app_dir: str, runs_dir: str, replicas: int, zygote: bool):
+    env = {'AIS_REPLICAS': str(replicas), 'AIS_ZYGOTE': 'true' if zygote else 'false'}
+    processes = []
+    start_time = time.perf_counter()
+
+    try:
+        if zygote:
+            run_dir = os.path.join(runs_dir, 'replica_0')
+            processes.append(start(app_dir, run_dir, env))
+            ready = wait_ready(processes[0], run_dir)
+            pids = [processes[0].pid]
+            for fork in ready['forks']:
+                wait_ready(None, fork['run_dir'])
+                pids.append(fork['pid'])
+        else:
+            run_dirs = [os.path.join(runs_dir, f'replica_{index}') for index in range(replicas)]
+            processes = [start(app_dir, run_dir, env) for run_dir in run_dirs]
+            for process, run_dir in zip(processes, run_dirs):
+                wait_ready(process, run_dir)
+            pids = [process.pid for process in processes]
+
+        elapsed = time.perf_counter() - start_time
+        return elapsed, [memory(pid) for pid in pids]
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replicas', type=int, default=4)
+    parser.add_argument('--weights-mb', type=float, default=500)
+    parser.add_argument('--model', help='Model package directory')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='ais_bench_') as tmp_dir:
+        app_dir = os.path.join(tmp_dir, 'app')
+        os.makedirs(app_dir)
+        install(app_dir, args.model, args.weights_mb)
+
+        print(f'{"mode":<10} {"start s":>8} {"replica":>8} {"rss MB":>10} {"pss MB":>10} {"private MB":>11}')
+        for zygote in (False, True):
+            mode = 'zygote' if zygote else 'separate'
+            elapsed, usages = bench(app_dir, os.path.join(tmp_dir, mode), args.replicas, zygote)
+            for index, usage in enumerate(usages):
+                print(
+                    f'{mode:<10} {elapsed:>8.2f} {index:>8} {usage["rss"] / 2 ** 20:>10.1f} '
+                    f'{usage["pss"] / 2 ** 20:>10.1f} {usage["private"] / 2 ** 20:>11.1f}'
+                )
+            total = sum(usage['pss'] for usage in usages)
+            print(f'{mode:<10} {elapsed:>8.2f} {"total":>8} {"":>10} {total / 2 ** 20:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,9 @@ from PIL import Image
 from timm.data import resolve_data_config
 from timm.data.transforms_factory import create_transform
 
+# Inputs of concurrent jobs can be stacked into one forward pass
+BATCHING = True
+
 
 def load():
     global model, transform, labels, top_k
@@ -4,6 +4,9 @@ import cv2
 import numpy as np
 import onnxruntime as ort
 
+# The predicted digit is written as text
+RESULT_SUFFIX = '.txt'
+
 
 def load():
     global session
@@ -0,0 +1,12 @@
+import os
+from unittest import mock
+
+from minio import Minio
+
+# The modules read their settings when they are imported. Unit tests don't use the
+# database, Redis or object storage, the URLs only have to be valid.
+os.environ.setdefault('DATABASE_URL', 'postgresql+psycopg2://localhost/ais')
+os.environ.setdefault('REDIS_URL', 'redis://localhost:6379/0')
+
+# object_storage creates its bucket when it is imported
+mock.patch.object(Minio, 'bucket_exists', return_value=True).start()
@@ -0,0 +1,79 @@
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+
+from ai_serving.worker_templates.batching import Batcher, Request
+
+
+def make_request(size: int) -> Request:
+    inputs = [np.zeros((size, 2), dtype=np.float32)]
+    return Request(inputs, ((2,), '<f4'), size, Future(), None)
+
+
+def double(inputs: list[np.ndarray]) -> list[np.ndarray]:
+    return [arr * 2 for arr in inputs]
+
+
+def test_split_by_request_size():
+    batcher = Batcher(double, max_batch_size=8, max_wait_ms=0)
+    outputs = [np.arange(6), np.arange(12).reshape(6, 2)]
+
+    results = batcher.split(outputs, [make_request(1), make_request(3), make_request(2)])
+
+    assert [[output.tolist() for output in result] for result in results] == [
+        [[0], [[0, 1]]],
+        [[1, 2, 3], [[2, 3], [4, 5], [6, 7]]],
+        [[4, 5], [[8, 9], [10, 11]]],
+    ]
+
+
+@pytest.mark.parametrize('output', [np.arange(5), np.array(1.0)])
+def test_split_rejects_outputs_without_a_row_per_input(output):
+    batcher = Batcher(double, max_batch_size=8, max_wait_ms=0)
+
+    with pytest.raises(ValueError):
+        batcher.split([output], [make_request(2), make_request(4)])
+
+
+def test_concurrent_calls_run_as_one_batch():
+    calls = []
+
+    def inference(inputs):
+        calls.append([arr.shape for arr in inputs])
+        return double(inputs)
+
+    # The batch is full after the second call, the wait never runs out
+    batcher = Batcher(inference, max_batch_size=3, max_wait_ms=60_000)
+    results = {}
+
+    def call(name, rows):
+        results[name] = batcher([np.full((rows, 2), rows, dtype=np.float32)])
+
+    threads = [threading.Thread(target=call, args=args) for args in [('a', 1), ('b', 2)]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    assert calls == [[(3, 2)]]
+    assert results['a'][0].tolist() == [[2, 2]]
+    assert results['b'][0].tolist() == [[4, 4], [4, 4]]
+
+
+def test_inputs_without_common_rows_are_not_batched():
+    threads = []
+
+    def inference(inputs):
+        threads.append(threading.current_thread().name)
+        return double(inputs)
+
+    batcher = Batcher(inference, max_batch_size=8, max_wait_ms=60_000)
+
+    outputs = batcher([np.ones(3), np.array(2.0)])
+
+    assert outputs[0].tolist() == [2, 2, 2]
+    assert outputs[1] == 4
+    # Never at the same time as a batch
+    assert threads == ['batcher']
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from ai_serving.worker_templates import common
+
+
+def arrays() -> list[np.ndarray]:
+    return [
+        np.arange(12, dtype=np.float32).reshape(3, 4),
+        # Not contiguous
+        np.arange(20, dtype=np.int64).reshape(4, 5)[:, ::2],
+        np.array(3.5),
+        np.zeros((0, 7), dtype=np.uint8),
+        np.array([1, 2, 3], dtype='>i4'),
+        np.array([True, False]),
+    ]
+
+
+def encode(arg: list[np.ndarray], codec: str) -> bytearray:
+    return bytearray(b''.join(bytes(buffer) for buffer in common.encode_ndarraylist(arg, codec)))
+
+
+@pytest.fixture(autouse=True)
+def shm_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(common, 'SHM_DIR', str(tmp_path))
+
+
+@pytest.mark.parametrize('codec', sorted(common.CODECS))
+def test_round_trip(codec):
+    decoded = common.decode_ndarraylist(encode(arrays(), codec))
+
+    assert len(decoded) == len(arrays())
+    for arr, expected in zip(decoded, arrays()):
+        assert arr.dtype == expected.dtype
+        assert arr.shape == expected.shape
+        np.testing.assert_array_equal(arr, expected)
+
+
+@pytest.mark.parametrize('codec', sorted(common.CODECS))
+def test_round_trip_of_no_arrays(codec):
+    assert common.decode_ndarraylist(encode([], codec)) == []
+
+
+def test_raw_arrays_are_aligned():
+    data = encode(arrays(), 'raw')
+
+    start = np.frombuffer(data, dtype=np.uint8).ctypes.data
+    for arr in common.decode_ndarraylist(data):
+        assert (arr.ctypes.data - start) % 64 == 0
+
+
+def test_shm_segment_path():
+    data = encode(arrays(), 'shm')
+
+    path = common.shm_segment_path(bytes(data))
+
+    assert path.startswith(common.SHM_DIR)
+    assert common.shm_segment_path(bytes(encode(arrays(), 'raw'))) is None
+
+
+@pytest.mark.parametrize('codec', sorted(common.CODECS))
+def test_object_arrays_are_rejected(codec):
+    if codec.startswith('npz'):
+        pytest.skip('np.savez pickles object arrays')
+
+    with pytest.raises(ValueError):
+        common.encode_ndarraylist([np.array([{}, None])], codec)
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        common.decode_ndarraylist(bytearray(b'garbage'))
+
+
+@pytest.mark.parametrize('available, preferred, expected', [
+    (['raw', 'npz'], None, 'raw'),
+    (['raw', 'npz'], ['lz4', 'npz', 'raw'], 'npz'),
+    (['npz'], ['raw', 'npz'], 'npz'),
+])
+def test_negotiate_codec(available, preferred, expected):
+    assert common.negotiate_codec(available, preferred) == expected
+
+
+@pytest.mark.parametrize('available, expected', [
+    (['npz', 'raw'], 'npz'),
+    ([], 'raw'),
+])
+def test_negotiate_codec_without_common_codec(available, expected):
+    assert common.negotiate_codec(available, ['lz4']) == expected
@@ -0,0 +1,49 @@
+import pytest
+from fastapi import HTTPException
+
+from ai_serving.http_headers import etag_matches, parse_range
+
+
+@pytest.mark.parametrize('if_none_match, expected', [
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"xyz", W/"abc"', True),
+    ('*', True),
+    ('"xyz"', False),
+    ('abc', False),
+])
+def test_etag_matches(if_none_match, expected):
+    assert etag_matches(if_none_match, '"abc"') == expected
+
+
+@pytest.mark.parametrize('range_header, expected', [
+    ('bytes=0-99', (0, 99)),
+    ('bytes=10-', (10, 999)),
+    ('bytes=990-2000', (990, 999)),
+    ('bytes=-100', (900, 999)),
+    ('bytes=-2000', (0, 999)),
+    ('BYTES = 5-5', (5, 5)),
+    # The whole object is sent for these
+    ('items=0-10', None),
+    ('bytes=0-10,20-30', None),
+    ('bytes=', None),
+    ('bytes=-', None),
+    ('bytes=a-10', None),
+    ('bytes=20-10', None),
+    ('bytes=0', None),
+])
+def test_parse_range(range_header, expected):
+    assert parse_range(range_header, 1000) == expected
+
+
+@pytest.mark.parametrize('range_header, size', [
+    ('bytes=1000-', 1000),
+    ('bytes=0-', 0),
+    ('bytes=-0', 1000),
+])
+def test_unsatisfiable_range(range_header, size):
+    with pytest.raises(HTTPException) as e:
+        parse_range(range_header, size)
+
+    assert e.value.status_code == 416
+    assert e.value.headers == {'Content-Range': f'bytes */{size}'}
@@ -0,0 +1,33 @@
+import asyncio
+
+import fakeredis
+
+from ai_serving import job_events
+
+
+def test_reader_survives_errors(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(job_events, 'publisher', fakeredis.FakeRedis(server=server))
+    monkeypatch.setattr(job_events.redis.asyncio.Redis, 'from_url', lambda url: fakeredis.FakeAsyncRedis(server=server))
+
+    async def watch():
+        watcher = job_events.JobWatcher()
+        queue = await watcher.subscribe(1)
+
+        get_message = watcher.pubsub.get_message
+        failures = [ValueError('not a Redis error')]
+
+        async def flaky_get_message(**kwargs):
+            if failures:
+                raise failures.pop()
+            return await get_message(**kwargs)
+
+        watcher.pubsub.get_message = flaky_get_message
+        job_events.publish({1: {'status': 'completed'}})
+
+        changes = await asyncio.wait_for(queue.get(), timeout=10)
+        assert changes == {'status': 'completed'}
+        assert await watcher.state(1) == {'status': 'completed'}
+        watcher.reader.cancel()
+
+    asyncio.run(watch())
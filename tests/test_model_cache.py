@@ -0,0 +1,111 @@
+import time
+
+from ai_serving.model_cache import ModelCache
+
+MB = 1024 * 1024
+
+
+class FakeWorker:
+
+    def __init__(self, model_id: int, memory: int):
+        self.model_id = model_id
+        self.memory = memory
+        self.pending_segments = False
+        self.stopped = False
+
+    def memory_usage(self) -> int:
+        return self.memory
+
+    def has_pending_segments(self) -> bool:
+        return self.pending_segments
+
+    def stop(self):
+        self.stopped = True
+
+
+def make_cache(memory: dict[int, int], **kwargs) -> tuple[ModelCache, dict[int, FakeWorker]]:
+    workers = {}
+
+    def load(model_id: int) -> FakeWorker:
+        workers[model_id] = FakeWorker(model_id, memory[model_id])
+        return workers[model_id]
+
+    return ModelCache(load, **kwargs), workers
+
+
+def test_least_recently_used_models_are_stopped_over_the_budget():
+    cache, workers = make_cache({1: 40 * MB, 2: 40 * MB, 3: 40 * MB}, memory_budget=100 * MB)
+    cache.get(1)
+    cache.get(2)
+    cache.get(1)
+
+    cache.get(3)
+
+    assert list(cache.workers) == [1, 3]
+    assert workers[2].stopped
+
+
+def test_models_in_use_are_not_stopped():
+    cache, workers = make_cache({1: 60 * MB, 2: 60 * MB}, memory_budget=100 * MB)
+
+    with cache.use(1):
+        cache.get(2)
+        assert list(cache.workers) == [1, 2]
+
+    # Evicted once the request finished, model 2 is the least recently used now
+    assert list(cache.workers) == [1]
+    assert workers[2].stopped
+
+
+def test_models_with_pending_segments_are_not_stopped():
+    cache, workers = make_cache({1: 60 * MB, 2: 60 * MB, 3: 60 * MB}, memory_budget=100 * MB)
+    cache.get(1)
+    workers[1].pending_segments = True
+
+    cache.get(2)
+    assert list(cache.workers) == [1, 2]
+
+    workers[1].pending_segments = False
+    cache.get(3)
+    assert list(cache.workers) == [3]
+    assert workers[1].stopped and workers[2].stopped
+
+
+def test_most_recent_model_stays_loaded_over_the_budget():
+    cache, workers = make_cache({1: 200 * MB}, memory_budget=100 * MB)
+
+    cache.get(1)
+
+    assert list(cache.workers) == [1]
+    assert not workers[1].stopped
+
+
+def test_idle_models_are_stopped():
+    cache, workers = make_cache({1: MB, 2: MB}, idle_timeout=60)
+    cache.get(1)
+    cache.get(2)
+    cache.last_used[1] = time.monotonic() - 61
+
+    cache.evict()
+
+    assert list(cache.workers) == [2]
+    assert workers[1].stopped
+
+
+def test_stop_all():
+    cache, workers = make_cache({1: MB, 2: MB})
+    cache.get(1)
+    cache.get(2)
+
+    cache.stop_all()
+
+    assert not cache.workers
+    assert all(worker.stopped for worker in workers.values())
+
+
+def test_loaded_doesnt_load():
+    cache, workers = make_cache({1: MB})
+
+    assert cache.loaded(1) is None
+    assert cache.get(1) is cache.loaded(1)
+    assert list(workers) == [1]
@@ -0,0 +1,150 @@
+import itertools
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+
+from ai_serving import models, object_storage, result_cache
+
+ETAGS = {
+    'models/mnist.zip': 'model-etag',
+    'inputs/image.png': 'image-etag',
+}
+
+
+@pytest.fixture(autouse=True)
+def redis_client(monkeypatch):
+    client = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(result_cache, 'client', client)
+    monkeypatch.setattr(object_storage, 'stat_object', lambda path: SimpleNamespace(etag=ETAGS[path]))
+    return client
+
+
+def text(index: int, value: str) -> dict:
+    return {'index': index, 'type': models.Type.TEXT, 'value': value}
+
+
+def file(index: int, value: str) -> dict:
+    return {'index': index, 'type': models.Type.FILE, 'value': value}
+
+
+def claim(job_id: int, argument_infos: list[dict] | None = None) -> tuple[str, str | None]:
+    return result_cache.claim(job_id, 'models/mnist.zip', argument_infos or [text(0, '3')])
+
+
+def test_cache_key_follows_model_and_inputs():
+    key = result_cache.cache_key('models/mnist.zip', [text(0, '3'), file(1, 'inputs/image.png')])
+
+    # Argument order doesn't matter, their index does
+    assert key == result_cache.cache_key('models/mnist.zip', [file(1, 'inputs/image.png'), text(0, '3')])
+    assert key != result_cache.cache_key('models/mnist.zip', [text(1, '3'), file(0, 'inputs/image.png')])
+    assert key != result_cache.cache_key('models/mnist.zip', [text(0, '4'), file(1, 'inputs/image.png')])
+
+    ETAGS['models/mnist.zip'] = 'new-model-etag'
+    try:
+        assert key != result_cache.cache_key('models/mnist.zip', [text(0, '3'), file(1, 'inputs/image.png')])
+    finally:
+        ETAGS['models/mnist.zip'] = 'model-etag'
+
+
+def test_uploads_are_keyed_by_their_path():
+    upload = f'uploads/{"a" * 64}.png'
+
+    assert result_cache.input_digest(file(0, upload)) == upload
+
+
+def test_identical_jobs_run_once():
+    assert claim(1) == ('run', None)
+    assert claim(2) == ('follow', None)
+    assert claim(3) == ('follow', None)
+    assert claim(4, [text(0, '4')]) == ('run', None)
+
+    assert result_cache.finish(1, 'results/1.txt') == [2, 3]
+    assert claim(5) == ('hit', 'results/1.txt')
+    assert result_cache.waiting() == []
+    assert result_cache.stats()['entries'] == 1
+
+
+def test_failed_job_releases_followers_without_a_result():
+    claim(1)
+    claim(2)
+
+    assert result_cache.finish(1) == [2]
+    assert result_cache.stats()['entries'] == 0
+    assert result_cache.waiting() == []
+    # The next identical job runs
+    assert claim(3) == ('run', None)
+
+
+def test_finish_of_a_job_that_didnt_claim():
+    assert result_cache.finish(1, 'results/1.txt') == []
+
+
+def test_least_recently_used_results_are_forgotten(monkeypatch):
+    monkeypatch.setattr(result_cache, 'RESULT_CACHE_MAX_ENTRIES', 2)
+    clock = itertools.count(1_700_000_000)
+    monkeypatch.setattr(result_cache.time, 'time', lambda: next(clock))
+    for job_id in range(3):
+        claim(job_id, [text(0, str(job_id))])
+        result_cache.finish(job_id, f'results/{job_id}.txt')
+
+    assert claim(10, [text(0, '0')]) == ('run', None)
+    assert claim(11, [text(0, '1')]) == ('hit', 'results/1.txt')
+    assert claim(12, [text(0, '2')]) == ('hit', 'results/2.txt')
+
+
+def test_waiting_jobs_of_a_lost_job_are_promoted():
+    claim(1)
+    claim(2)
+    claim(3)
+    key, = [key for key, _ in result_cache.waiting()]
+    assert result_cache.waiting() == [(key, 1)]
+
+    # Another sweeper promoted a job already
+    assert result_cache.promote(key, 4) is None
+
+    assert result_cache.promote(key, 1) == 2
+    assert result_cache.waiting() == [(key, 2)]
+    assert result_cache.promote(key, 2) == 3
+    assert result_cache.waiting() == []
+
+    assert result_cache.finish(3, 'results/3.txt') == []
+    assert claim(4) == ('hit', 'results/3.txt')
+
+
+def test_waiting_jobs_of_an_expired_job_are_promoted(redis_client):
+    claim(1)
+    claim(2)
+    key, = [key for key, _ in result_cache.waiting()]
+    redis_client.delete(result_cache.running_key(key))
+
+    assert result_cache.waiting() == [(key, None)]
+    assert result_cache.promote(key, None) == 2
+    assert result_cache.finish(2, 'results/2.txt') == []
+    # The lost job finishing late doesn't release anything
+    assert result_cache.finish(1, 'results/1.txt') == []
+
+
+def test_claim_runs_the_job_when_redis_fails(monkeypatch):
+    server = fakeredis.FakeServer()
+    server.connected = False
+    monkeypatch.setattr(result_cache, 'client', fakeredis.FakeRedis(server=server, decode_responses=True))
+
+    assert claim(1) == ('run', None)
+
+
+def test_heartbeat_while_a_stage_runs(monkeypatch):
+    monkeypatch.setattr(result_cache, 'RESULT_CACHE', True)
+    heartbeat = result_cache.Heartbeat(interval=60)
+
+    with heartbeat.beating(1):
+        assert result_cache.alive([1, 2]) == {1}
+        assert list(heartbeat.running) == [1]
+    assert not heartbeat.running
+
+
+def test_heartbeat_expires(redis_client):
+    result_cache.beat([1])
+    redis_client.expire(result_cache.heartbeat_key(1), 0)
+
+    assert result_cache.alive([1]) == set()